@@ -1,52 +1,170 @@
 import asyncio
-from threading import Thread
 import httpx
-from typing import Any, Callable
+from typing import Any, AsyncIterator, Callable, Coroutine, Hashable, Iterator
+from concurrent.futures import Future
+from threading import Lock, Thread
+from importlib.util import find_spec
+from time import monotonic
+import weakref
 import unittest
+from unittest import mock
+
+# per peer connection limits, shared by every pool
+MAX_CONNECTIONS_PER_PEER = 16
+MAX_KEEPALIVE_PER_PEER = 8
+KEEPALIVE_EXPIRY = 30
+# httpx only speaks http2 when the h2 package is installed
+HTTP2 = find_spec("h2") is not None
+
+# keeps one long lived AsyncClient per peer so requests reuse open connections.
+# httpx clients are bound to the event loop they were first used on, so every loop gets its own pool
+class ConnectionPool:
+    def __init__(self) -> None:
+        self.clients: dict[str, httpx.AsyncClient] = {}
+
+    def client(self, address: str) -> httpx.AsyncClient:
+        client = self.clients.get(address)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=f"http://{address}",
+                http2=HTTP2,
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS_PER_PEER,
+                    max_keepalive_connections=MAX_KEEPALIVE_PER_PEER,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+            )
+            self.clients[address] = client
+        return client
+
+    async def close(self):
+        clients = list(self.clients.values())
+        self.clients.clear()
+        for client in clients:
+            await client.aclose()
+
+_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ConnectionPool]" = weakref.WeakKeyDictionary()
+
+# pool for the currently running loop
+def getPool() -> ConnectionPool:
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = ConnectionPool()
+        _pools[loop] = pool
+    return pool
 
 #each thread needs one Executor for sending broadcast messages in the background
 class Executor:
     def __init__(self) -> None:
         self.loop = asyncio.new_event_loop()
+        self.pool = ConnectionPool()
+        _pools[self.loop] = self.pool
         thread = Thread(target=__class__._run, args=[self.loop], daemon=True)
         thread.start()
 
     def _run(loop: asyncio.AbstractEventLoop):
         asyncio.set_event_loop(loop)
         loop.run_forever()
+
+    # moves background work onto a loop that is already running, e.g. the one serving ASGI requests,
+    # and stops the private loop
+    def adopt(self, loop: asyncio.AbstractEventLoop):
+        old = self.loop
+        self.loop = loop
+        self.pool = _pools.setdefault(loop, ConnectionPool())
+        old.call_soon_threadsafe(old.stop)
     
     def run(self, asyncFuncRet):
         return asyncio.run_coroutine_threadsafe(asyncFuncRet, self.loop)
 
+    # drives an async generator on the executor loop from synchronous code, e.g. a streamed wsgi response
+    def iterate(self, agen: AsyncIterator) -> Iterator:
+        try:
+            while True:
+                try:
+                    yield self.run(agen.__anext__()).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(agen.aclose()).result()
+
 
 
+# how long a finished call keeps being handed to new callers
+SINGLE_FLIGHT_TTL = 0.25
+
+# callers asking for the same key at the same time share one call, which runs on the executor
+# loop so callers on any thread or loop can wait for it
+class SingleFlight:
+    def __init__(self, executor: Executor, ttl: float = SINGLE_FLIGHT_TTL) -> None:
+        self.executor = executor
+        self.ttl = ttl
+        self.calls: dict[Hashable, Future] = {}
+        self.lock = Lock()
+
+    async def do(self, key: Hashable, makeCoroutine: Callable[[], Coroutine]):
+        with self.lock:
+            future = self.calls.get(key)
+            if future is None:
+                future = self.executor.run(makeCoroutine())
+                self.calls[key] = future
+                future.add_done_callback(lambda f: self.executor.loop.call_soon_threadsafe(self._expireLater, key, f))
+        # one caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _expireLater(self, key: Hashable, future: Future):
+        self.executor.loop.call_later(self.ttl, self._expire, key, future)
+
+    def _expire(self, key: Hashable, future: Future):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+# sends started on any other loop are run on this executor's loop, so they share its long lived pool.
+# flask runs every async view on a new loop, a pool per loop would open new connections per request
+_home: Executor | None = None
+
+def sendFrom(executor: Executor | None):
+    global _home
+    _home = executor
+
+# the executor to hand a send to, None if the running loop can send itself
+def _away() -> Executor | None:
+    if _home is None or asyncio.get_running_loop() is _home.loop:
+        return None
+    return _home
+
 # callback is response body, status code, sender address
 async def sendWithCallback(method: str, address:str, endpoint: str, data, timeout, callback: Callable[[str, int, str], Any] | None, responses: dict | None = None):
-    url = f"http://{address + endpoint}"
-    async with httpx.AsyncClient() as client:
-        try:
-            res = await client.request(method, url, json=data, timeout=timeout)
-        except httpx.RequestError:
-            if responses:
-                responses[address] = None
-            return
-        code = res.status_code
-        body = res.text
-        if callback is not None:
-            callBackResponse = callback(body, code, address)
-            if responses is not None:
-                responses[address] = callBackResponse
+    if (home := _away()) is not None:
+        # cancelling the wrapper cancels the send on the home loop too
+        return await asyncio.wrap_future(home.run(sendWithCallback(method, address, endpoint, data, timeout, callback, responses)))
+    client = getPool().client(address)
+    try:
+        res = await client.request(method, endpoint, json=data, timeout=timeout)
+    except httpx.RequestError:
+        if responses:
+            responses[address] = None
+        return
+    code = res.status_code
+    body = res.text
+    if callback is not None:
+        callBackResponse = callback(body, code, address)
+        if responses is not None:
+            responses[address] = callBackResponse
 
 async def sendAsync(method: str, address:str, endpoint: str, data, timeout) -> tuple[str, int]:
-    url = f"http://{address + endpoint}"
-    async with httpx.AsyncClient() as client:
-        try:
-            res = await client.request(method, url, json=data, timeout=timeout)
-        except httpx.RequestError:
-            return None, -1
-        code = res.status_code
-        body = res.text
-        return body, code
+    if (home := _away()) is not None:
+        return await asyncio.wrap_future(home.run(sendAsync(method, address, endpoint, data, timeout)))
+    client = getPool().client(address)
+    try:
+        res = await client.request(method, endpoint, json=data, timeout=timeout)
+    except httpx.RequestError:
+        return None, -1
+    code = res.status_code
+    body = res.text
+    return body, code
 
 async def broadcastAll(method, addresses: list[str], endpoint, data, timeout, callback: Callable[[str, int, str], Any] | None = None) -> dict:
     res = {}
@@ -73,11 +191,171 @@ async def broadcastOne(method, addresses: list[str], endpoint: str, data, timeou
             return None
         futures = pending
 
+# weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.2
+# a replica that answers errors is ranked as if it were this many seconds slower per unit of error rate
+ERROR_PENALTY = 1.0
+# the next replica is tried once the current one takes HEDGE_FACTOR times its usual latency
+HEDGE_FACTOR = 3
+MIN_HEDGE_DELAY = 0.05
+
+# keeps an exponentially weighted moving average of latency and error rate per peer
+class ReplicaSelector:
+    def __init__(self, alpha: float = EWMA_ALPHA) -> None:
+        self.alpha = alpha
+        self.latency: dict[str, float] = {}
+        self.errors: dict[str, float] = {}
+
+    def record(self, address: str, seconds: float, ok: bool):
+        a = self.alpha
+        if address in self.latency:
+            self.latency[address] = (1 - a) * self.latency[address] + a * seconds
+        else:
+            self.latency[address] = seconds
+        self.errors[address] = (1 - a) * self.errors.get(address, 0) + a * (0 if ok else 1)
+
+    # peers we never talked to score 0 so they get tried
+    def score(self, address: str) -> float:
+        return self.latency.get(address, 0) + ERROR_PENALTY * self.errors.get(address, 0)
+
+    def order(self, addresses: list[str]) -> list[str]:
+        return sorted(addresses, key=self.score)
+
+    def hedgeDelay(self, address: str) -> float:
+        return max(MIN_HEDGE_DELAY, HEDGE_FACTOR * self.latency.get(address, 0))
+
+# sends to the best replica first and only to the next one when it fails or is slower than usual.
+# any answer below 500 is final, returns None if every replica failed
+async def broadcastHedged(method, addresses: list[str], endpoint: str, data, timeout, selector: ReplicaSelector) -> tuple[str, int] | None:
+    candidates = selector.order(addresses)
+    async def timed(address):
+        start = monotonic()
+        try:
+            body, code = await sendAsync(method, address, endpoint, data, timeout)
+        except asyncio.CancelledError:
+            # lost to a hedge, it took at least this long
+            selector.record(address, monotonic() - start, True)
+            raise
+        selector.record(address, monotonic() - start, code != -1 and code < 500)
+        return body, code
+    pending: set[asyncio.Task] = set()
+    nextIndex = 0
+    hedgeDelay = None
+    try:
+        while True:
+            if not pending or hedgeDelay is None:
+                if nextIndex >= len(candidates):
+                    if not pending:
+                        return None
+                else:
+                    address = candidates[nextIndex]
+                    nextIndex += 1
+                    pending.add(asyncio.create_task(timed(address)))
+                    hedgeDelay = selector.hedgeDelay(address) if nextIndex < len(candidates) else None
+            done, pending = await asyncio.wait(pending, timeout=hedgeDelay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # too slow, hedge to the next replica
+                hedgeDelay = None
+                continue
+            for task in done:
+                body, code = task.result()
+                if code != -1 and code < 500:
+                    return body, code
+            # failed, move on to the next replica right away
+            hedgeDelay = None
+    finally:
+        for task in pending:
+            task.cancel()
+
+# for requests too big to send twice: replicas are tried one at a time, best first, until one answers
+async def broadcastFailover(method, addresses: list[str], endpoint: str, data, timeout, selector: ReplicaSelector) -> tuple[str, int] | None:
+    for address in selector.order(addresses):
+        start = monotonic()
+        body, code = await sendAsync(method, address, endpoint, data, timeout)
+        selector.record(address, monotonic() - start, code != -1 and code < 500)
+        if code != -1 and code < 500:
+            return body, code
+    return None
+
 class Tests(unittest.IsolatedAsyncioTestCase):
     async def testOne(self):
         ips = ["localhost:8082"]
         res = await broadcastOne("GET", ips, "/", {}, 10)
         print(res, flush=True)
 
+    # fake sendAsync, every address answers code after delay seconds
+    def fakeSends(self, answers: dict[str, tuple[float, int]]):
+        self.called, self.cancelled = [], []
+        async def send(method, address, endpoint, data, timeout):
+            self.called.append(address)
+            delay, code = answers[address]
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.cancelled.append(address)
+                raise
+            return address, code
+        return mock.patch("background.sendAsync", send)
+
+    async def testHedge(self):
+        selector = ReplicaSelector()
+        selector.record("slow", 0.02, True)
+        selector.record("fast", 0.03, True)
+        with self.fakeSends({"slow": (1, 200), "fast": (0, 200)}):
+            start = monotonic()
+            res = await broadcastHedged("GET", ["fast", "slow"], "/", {}, 1, selector)
+            elapsed = monotonic() - start
+        self.assertEqual(res, ("fast", 200))
+        self.assertEqual(self.called, ["slow", "fast"])
+        # hedged only after 3 times the usual latency of slow
+        self.assertGreaterEqual(elapsed, 0.06)
+        self.assertLess(elapsed, 0.5)
+        # the loser is cancelled on return and sees it the next time it runs
+        await asyncio.sleep(0)
+        self.assertEqual(self.cancelled, ["slow"])
+
+    async def testFailover(self):
+        selector = ReplicaSelector()
+        with self.fakeSends({"a": (0, 503), "b": (0, 404)}):
+            self.assertEqual(await broadcastHedged("GET", ["a", "b"], "/", {}, 1, selector), ("b", 404))
+        self.assertEqual(self.called, ["a", "b"])
+        self.assertLess(selector.score("b"), selector.score("a"))
+        with self.fakeSends({"a": (0, 500), "b": (0, -1)}):
+            self.assertIsNone(await broadcastFailover("PUT", ["a", "b"], "/", {}, 1, selector))
+            self.assertIsNone(await broadcastHedged("GET", ["a", "b"], "/", {}, 1, selector))
+        with self.fakeSends({"a": (0, 500), "b": (0, 200)}):
+            self.assertEqual(await broadcastFailover("PUT", ["a", "b"], "/", {}, 1, ReplicaSelector()), ("b", 200))
+        self.assertEqual(self.called, ["a", "b"])
+
+    async def testSingleFlight(self):
+        flight = SingleFlight(Executor(), ttl=0)
+        calls = []
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return len(calls)
+        results = await asyncio.gather(*[flight.do("key", fetch) for _ in range(5)])
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(len(calls), 1)
+        await asyncio.sleep(0.05)
+        self.assertEqual(await flight.do("key", fetch), 2)
+
+    async def testSendsRunOnHomeLoop(self):
+        home = Executor()
+        loops = []
+        def pool():
+            loops.append(asyncio.get_running_loop())
+            client = mock.Mock()
+            client.request = mock.AsyncMock(side_effect=httpx.ConnectError("refused"))
+            return mock.Mock(client=mock.Mock(return_value=client))
+        sendFrom(home)
+        try:
+            with mock.patch("background.getPool", pool):
+                self.assertEqual(await sendAsync("GET", "peer", "/", {}, 1), (None, -1))
+                await sendWithCallback("GET", "peer", "/", {}, 1, None)
+        finally:
+            sendFrom(None)
+        self.assertEqual(loops, [home.loop, home.loop])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -6,89 +6,95 @@ import sys
 from time import sleep, time
 import httpx
 import json
-from background import Executor, broadcastAll
-from operations import OperationGenerator, Operation
+from background import Executor, SingleFlight, broadcastAll
+from replication import Replicator
+from operations import OperationGenerator, Operation, CausalContext
 from consistent_hashing import HashRing
 from key_reshuffle import ViewType
 
 # collection of kv
 
-def RelevantCausalMetaDataToSet(l: list[str] | None, key: str) -> set[str]:
-    if l is None:
-        return set()
-    return set(filter(lambda op: Operation.fromString(op).key == key, l))
-
 async def getMissingDependencies(md: Operation, nodes: list[str], data: Kvs):
 
-    def putResInData(res, _code, _sender) -> KvsNode:
-        res = json.loads(res)
-        node = KvsNode.fromDict(res)
-        return node
+    def putResInData(res, _code, _sender) -> dict:
+        return json.loads(res)
     print("missing dependency: ", md.key, flush=True)
-    retDict: dict[str, KvsNode] = await broadcastAll("GET", nodes, f"/keys/{md.key}", {}, 1, putResInData)
+    retDict: dict[str, dict] = await broadcastAll("GET", nodes, f"/keys/{md.key}", {}, 1, putResInData)
     
     # put all nodes in kvs, let kvs figure out which one to keep lol
-    for node in retDict.values():
-        if node is EMPTY_NODE or node is None:
+    for shipped in retDict.values():
+        if shipped is None or "uninit" in shipped:
             print("hi")
             continue
-        data.put(md.key, node)
-
-async def getData(key: str, request: dict, *, nodes: list[str], data: Kvs, hashRing: HashRing, associatedNodes: ViewType) -> tuple[dict, int]:
-    tInit = time()
-
-    causalMetaData:list[str] = request.get("causal-metadata", {}).get("ops", [])
-    causalMetaDataSet = set(causalMetaData if causalMetaData else [])
-    requestDependsOn = RelevantCausalMetaDataToSet(causalMetaData, key)
-    tries = 0
-    while time() - tInit < 20:
-
-        node = data.get(key)
-
-        nodeDependsOn = set([*map(repr, node.dependencies)])
-
-        # if node is not EMPTY_NODE:
-        #     nodeDependsOn.add(repr(node.operation))
-
-        #find missing dependencies
-        missingDependencies = requestDependsOn.difference( data.opsSeen() )
-
-        if len(missingDependencies) == 0:
-            newCausal = list(nodeDependsOn.union(causalMetaDataSet))
-            if node is EMPTY_NODE or node.value == None:
+        data.putShipped(md.key, shipped)
+
+# how long a read waits for replication before asking the shard again, doubled after every try
+REFETCH_DELAY = 0.5
+
+async def getData(key: str, request: dict, *, nodes: list[str], data: Kvs, hashRing: HashRing, associatedNodes: ViewType, singleFlight: SingleFlight) -> tuple[dict, int]:
+    deadline = time() + 20
+
+    causalMetaData = CausalContext.fromMetadata(request.get("causal-metadata"))
+    refetchDelay = REFETCH_DELAY
+    fetched: set[Operation] = set()
+    fetches: list[asyncio.Task] = []
+    waiters: list[asyncio.Future] = []
+    try:
+        while True:
+            #find missing dependencies. checked before reading the node, kvs marks an operation seen only
+            #once its node is stored, so the node read next is that one or a later one
+            missingDependencies = data.missing(key, causalMetaData)
+
+            if len(missingDependencies) == 0:
+                node = data.node(key)
+                causalMetaData.merge(node.dependencies)
+                # stable operations are satisfied everywhere, clients don't need to carry them
+                causalMetaData = data.prune(causalMetaData)
+                if node is EMPTY_NODE or node.value == None:
+                    return {
+                        "causal-metadata": causalMetaData.asMetadata()
+                    }, 404
                 return {
-                    "causal-metadata": {"ops": newCausal}
-                }, 404
-            return {
-                "val": node.value,
-                "causal-metadata": {"ops": newCausal}
-            }, 200
-        
-        async with asyncio.TaskGroup() as tg:
-            for dependency in missingDependencies:
-                op = Operation.fromString(dependency)
-                if op.key != key:
-                    continue #skip keys that arent this key
-                keyShardId, hash = hashRing.assign(key)
-                print("SHARDID of missing dependency = ", keyShardId)
-                tg.create_task(getMissingDependencies(op, associatedNodes[keyShardId], data))
-        #now we have our dependencies, go back to top of loop and try again
-        if tries != 0:
-            await asyncio.sleep(0.5)
-        tries += 1
-    return {"error": "timed out while waiting for depended updates"}, 500
-     
-    
-
-
-
-    
-
-    
-    
-
-
-def putData(key: str, request: dict, *, data: Kvs, executor: Executor, nodes: list[str]) -> tuple[dict, int]:
+                    "val": node.value,
+                    "causal-metadata": causalMetaData.asMetadata()
+                }, 200
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return {"error": "timed out while waiting for depended updates"}, 500
+
+            # put wakes us up as soon as the dependencies arrive, through replication, gossip or our own fetch
+            data.stopWaiting(key, waiters)
+            waiters = [data.waitFor(op) for op in missingDependencies]
+            keyShardId, hash = hashRing.assign(key)
+            for op in missingDependencies:
+                if op in fetched:
+                    continue
+                print("missing dependency in", keyShardId, flush=True)
+                fetched.add(op)
+                # concurrent reads missing the same op share one fetch
+                shard = associatedNodes[keyShardId]
+                fetches.append(asyncio.create_task(singleFlight.do(
+                    (key, op), lambda op=op, shard=shard: getMissingDependencies(op, shard, data)
+                )))
+            done, pending = await asyncio.wait(waiters, timeout=min(remaining, refetchDelay))
+            if pending:
+                # nobody had it yet, ask again next time around
+                fetched.clear()
+                refetchDelay *= 2
+    finally:
+        data.stopWaiting(key, waiters)
+        for task in fetches:
+            task.cancel()
+
+# a write supersedes everything this replica has seen on its key, so it still wins over
+# operations that were dropped from the client's metadata once they became stable
+def writeDependencies(key: str, metadata: dict | None, data: Kvs) -> CausalContext:
+    dependencies = CausalContext.fromMetadata(metadata)
+    dependencies.mergeClock(key, data.frontier(key))
+    return dependencies
+
+def putData(key: str, request: dict, *, data: Kvs, replicator: Replicator, nodes: list[str]) -> tuple[dict, int]:
     val = request.get("val")
     msTimestamp=request.get("timestamp")
     if val == None:
@@ -99,40 +105,33 @@ def putData(key: str, request: dict, *, data: Kvs, executor: Executor, nodes: li
     if metadata is None:
         return {"error": "bad request"}, 400
 
-    reqCausal = []
-    ops = metadata.get("ops")
-    reqCausal.extend(ops if ops else [])
-
     op = Operation.fromString(request["operation"])
-    node = KvsNode(request["val"], operation=op, msSinceEpoch=msTimestamp, dependencies=[*map(Operation.fromString, reqCausal)])
+    node = KvsNode(request["val"], operation=op, msSinceEpoch=msTimestamp, dependencies=writeDependencies(key, metadata, data))
     isNew = data.put(key, node)
+    if isNew is None:
+        return {"error": "operation already applied", "operation": repr(op)}, 409
     code = 201 if isNew else 200
-    executor.run(
-        broadcastAll( "PUT", nodes, f"/keys/{key}", node.asDict(), timeout=1 )
-    )
+    replicator.put(nodes, key, node)
 
-    # new array because node owns the old array
-    sendBackCausal=[repr(op)]
-    sendBackCausal.extend(reqCausal)
+    # the node's dependencies are the request's plus this operation
     return {
-        "causal-metadata": {"ops": sendBackCausal},
+        "causal-metadata": node.dependencies.asMetadata(),
         "replaced": not isNew
         }, code
 
-def deleteData(key: str, request: dict, *, data: Kvs, executor: Executor, nodes: list[str]) -> tuple[dict, int]:
-    msTimestamp = time() * 1000
+# deletes are stored as tombstone nodes so they are ordered and replicated like any other write
+def deleteData(key: str, request: dict, *, data: Kvs, replicator: Replicator, nodes: list[str]) -> tuple[dict, int]:
+    msTimestamp = request.get("timestamp", time() * 1000)
     metadata = request.get("causal-metadata", {})
-    reqCausal = []
-    if metadata:
-        ops = metadata.get("ops")
-        reqCausal.extend(ops if ops else [])
 
     op = Operation.fromString(request["operation"])
-    success = data.delete(key)
+    success = data.get(key) is not EMPTY_NODE
+    node = KvsNode(None, operation=op, msSinceEpoch=msTimestamp, dependencies=writeDependencies(key, metadata, data))
+    if data.put(key, node) is None:
+        return {"error": "operation already applied", "operation": repr(op)}, 409
     code = 200 if success else 404
-    executor.run(broadcastAll("DELETE", nodes, f"/keys/{key}", "", timeout=1))
-    reqCausal.append(repr(op))
-    return {"causal-metadata": {"ops": reqCausal}}, code
+    replicator.put(nodes, key, node)
+    return {"causal-metadata": node.dependencies.asMetadata()}, code
 
 
 def update_view_data(view, data: Kvs, executor: Executor, nodes: list[str]) -> int:
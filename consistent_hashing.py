@@ -1,9 +1,26 @@
 import hashlib
+import unittest
+import zlib
+from array import array
 from bisect import bisect
+from functools import lru_cache
+from heapq import merge
+from operator import itemgetter
+try:
+    import numpy as np
+except ImportError:  # assign_many falls back to bisect
+    np = None
 
 # using sha256 rn
 def hash_fn(key: str, max_hashes: int) -> int:
-    return int(hashlib.sha256(key.encode()).hexdigest(), 16) % max_hashes
+    # same value as int(hexdigest, 16) without building and parsing the hex string
+    return int.from_bytes(hashlib.sha256(key.encode()).digest(), 'big') % max_hashes
+
+# non-cryptographic alternative for ring placement, roughly 4x faster than hash_fn.
+# every node has to use the same function or they will disagree on key ownership
+def fast_hash_fn(key: str, max_hashes: int) -> int:
+    data = key.encode()
+    return (zlib.crc32(data) << 32 | zlib.adler32(data)) % max_hashes
 
 # def bisect(keys, hash):
 #     maxIndex = 0
@@ -13,65 +30,215 @@ def hash_fn(key: str, max_hashes: int) -> int:
 #             return i
 #     return 0
 
+# the "real" shard followed by its virtual shards.
+# since the hashing algorithm is uniformly random. Take the hash of the hash virtual_shards times.
+# positions only depend on the shard name, so they are cached across ring rebuilds
+@lru_cache(maxsize=1024)
+def shard_points(shard: str, max_hashes: int, virtual_shards: int, hasher=hash_fn) -> tuple[int, ...]:
+    key = hasher(shard, max_hashes)
+    points = [key]
+    for i in range(virtual_shards):
+        virtual_key = hasher(str(key), max_hashes)
+        points.append(virtual_key)
+        key = str(virtual_key)
+    return tuple(points)
+
+# number of keys remembered by the hash memo and by the routing cache
+CACHE_SIZE = 65536
+
 class HashRing:
-    def __init__(self, max_hashes, virtual_shards):
-        self.keys = []  # stores indexes on the HashRing where shards are
-        self.shards = []  # stores the names of the shards
-        # shards[i] is present on the HashRing at keys[i]
+    def __init__(self, max_hashes, virtual_shards, hasher=hash_fn, cache_size=CACHE_SIZE):
         self.max_hashes = max_hashes
         self.virtual_shards = virtual_shards  # number of shards in addition to the 'real' shard.
+        self.hasher = hasher
+        # bumped on every ring change, routing cache entries from older epochs are never hit again
+        self.epoch = 0
+        self._hash_cached = lru_cache(maxsize=cache_size)(self._hash)
+        self._route_cached = lru_cache(maxsize=cache_size)(self._route)
+        # (keys, shard_ids, shard_names), replaced as a whole so readers never see half of a change
+        self._ring = (self._key_array(), array('I'), [])
+        self._ring_array = None  # (keys, numpy view of keys) for assign_many
 
-    
+    # ring positions fit in a compact unsigned array unless max_hashes is wider than 64 bits
+    def _key_array(self, values=()):
+        if self.max_hashes <= 2**64:
+            return array('Q', values)
+        return list(values)
 
-    def add_shard(self, shard: str):
-        key = hash_fn(shard, self.max_hashes)
-        index = bisect(self.keys, key)
+    @property
+    def keys(self):  # sorted indexes on the HashRing where shards are
+        return self._ring[0]
 
-        self.keys.insert(index, key)  # insert "real" shard
-        self.shards.insert(index, shard)
+    @property
+    def shard_ids(self) -> array:  # shard_names[shard_ids[i]] is present on the HashRing at keys[i]
+        return self._ring[1]
 
-        # since the hashing algorithm is uniformly random. Take the hash of the hash self.virtual_shards times and also
-        # add those to the hashring under the shard name
-        for i in range(self.virtual_shards):  # insert virtual shards
-            virtual_key = hash_fn(str(key), self.max_hashes)
-            index = bisect(self.keys, virtual_key)
-            self.keys.insert(index, virtual_key)
-            self.shards.insert(index, shard)
-            key = str(virtual_key)
+    @property
+    def shard_names(self) -> list[str]:
+        return self._ring[2]
 
-    def remove_shard(self, shard):
-        if len(self.keys) == 0:
-            raise Exception("HashRing Empty")
+    # builds the whole ring with one sort instead of one insert per virtual shard
+    @classmethod
+    def fromShards(cls, shards, max_hashes, virtual_shards, hasher=hash_fn) -> "HashRing":
+        ring = cls(max_hashes, virtual_shards, hasher)
+        ring.rebuild(shards)
+        return ring
+
+    def rebuild(self, shards):
+        names = list(shards)
+        keys: list[int] = []
+        ids: list[int] = []
+        for i, shard in enumerate(names):
+            points = self._points(shard)
+            keys.extend(points)
+            ids.extend([i] * len(points))
+        # stable, so equal positions keep the order add_shard would have given them
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._set_ring([keys[j] for j in order], [ids[j] for j in order], names)
 
-        key = hash_fn(shard, self.max_hashes)
-        index = bisect(self.keys, key)
+    def _points(self, shard: str) -> tuple[int, ...]:
+        return shard_points(shard, self.max_hashes, self.virtual_shards, self.hasher)
 
-        if index >= len(self.keys) or self.keys[index] != key:
+    def _set_points(self, points, names: list[str]):
+        points = list(points)
+        self._set_ring([p[0] for p in points], [p[1] for p in points], names)
+
+    # the new ring is published before the epoch moves, so a route cached under the new epoch
+    # was always computed from the new ring
+    def _set_ring(self, keys: list[int], ids: list[int], names: list[str]):
+        self._ring = (self._key_array(keys), array('I', ids), names)
+        self.epoch += 1
+        self._route_cached.cache_clear()
+
+    @property
+    def shards(self) -> list[str]:  # name of the shard at every position of the ring
+        return [self.shard_names[i] for i in self.shard_ids]
+
+    def add_shard(self, shard: str):
+        keys, ids, names = self._ring
+        if shard in names:
+            index = names.index(shard)
+        else:
+            index = len(names)
+            names = names + [shard]
+        new = sorted(((key, index) for key in self._points(shard)), key=itemgetter(0))
+        # merge is stable, new points go after existing ones at the same position
+        self._set_points(merge(zip(keys, ids), new, key=itemgetter(0)), names)
+
+    def remove_shard(self, shard):
+        keys, ids, names = self._ring
+        if len(keys) == 0:
+            raise Exception("HashRing Empty")
+        if shard not in names:
             raise Exception("Shard not in HashRing")
 
-        for i in reversed(range(len(self.keys))):  # remove shards
-            if self.shards[i] == shard:
-                self.keys.pop(i)
-                self.shards.pop(i)
+        removed = names.index(shard)
+        # shards after the removed one shift down by one
+        self._set_points(
+            ((key, i if i < removed else i - 1) for key, i in zip(keys, ids) if i != removed),
+            names[:removed] + names[removed + 1:],
+        )
 
-        return key
+        return self.hasher(shard, self.max_hashes)
 
     def assign(self, val) -> tuple[str, int]:  # returns which shard a thing should be assigned to
-        hash = hash_fn(val, self.max_hashes)
+        return self._route_cached(val, self.epoch)
+
+    def _route(self, val, epoch) -> tuple[str, int]:
+        hash = self.hash(val)
         return (self.assign_prehashed(hash), hash)
 
+    # ring position of val, memoized across ring changes
+    def hash(self, val) -> int:
+        return self._hash_cached(val)
+
+    def _hash(self, val) -> int:
+        return self.hasher(val, self.max_hashes)
+
     def assign_prehashed(self, hash: int):
-        index = bisect(self.keys, hash) % len(self.keys)
-        return self.shards[index]
+        keys, ids, names = self._ring
+        index = bisect(keys, hash) % len(keys)
+        return names[ids[index]]
+
+    # assigns every key at once, returns shard -> keys assigned to it
+    def assign_many(self, keys) -> dict[str, list[str]]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        ringKeys, ids, names = self._ring
+        if len(ringKeys) == 0:
+            raise Exception("HashRing Empty")
+        hashes = [self.hasher(k, self.max_hashes) for k in keys]
+        if np is not None and self.max_hashes <= 2**64:
+            cached = self._ring_array
+            if cached is None or cached[0] is not ringKeys:
+                cached = self._ring_array = (ringKeys, np.frombuffer(ringKeys, dtype=np.uint64))
+            owners = (np.searchsorted(cached[1], np.array(hashes, dtype=np.uint64), side="right") % len(ringKeys)).tolist()
+        else:
+            owners = [bisect(ringKeys, h) % len(ringKeys) for h in hashes]
+        grouped: dict[str, list[str]] = {}
+        for k, i in zip(keys, owners):
+            shard = names[ids[i]]
+            if shard in grouped:
+                grouped[shard].append(k)
+            else:
+                grouped[shard] = [k]
+        return grouped
 
     def clear(self):
-        self.keys.clear()
-        self.shards.clear()
+        self._set_ring([], [], [])
 
     def print_ring(self):
         print(*zip(self.keys, self.shards))
 
 
+class Tests(unittest.TestCase):
+    def testAssignMany(self):
+        hr = HashRing(2**64, 50)
+        for shard in ['shard1', 'shard2', 'shard3']:
+            hr.add_shard(shard)
+        keys = ["key" + str(i) for i in range(1000)]
+        grouped = hr.assign_many(keys)
+        self.assertEqual(sum(map(len, grouped.values())), len(keys))
+        for shard, assigned in grouped.items():
+            for k in assigned:
+                self.assertEqual(hr.assign(k)[0], shard)
+
+    def testBulkBuild(self):
+        shards = ['shard1', 'shard2', 'shard3', 'shard4']
+        hr = HashRing(2**64, 50)
+        for shard in shards:
+            hr.add_shard(shard)
+        built = HashRing.fromShards(shards, 2**64, 50)
+        self.assertEqual(list(hr.keys), list(built.keys))
+        self.assertEqual(hr.shards, built.shards)
+
+        hr.remove_shard('shard2')
+        without = HashRing.fromShards(['shard1', 'shard3', 'shard4'], 2**64, 50)
+        self.assertEqual(list(hr.keys), list(without.keys))
+        self.assertEqual(hr.shards, without.shards)
+        self.assertRaises(Exception, hr.remove_shard, 'shard2')
+
+    def testRoutingCache(self):
+        hr = HashRing.fromShards(['shard1', 'shard2'], 2**64, 50, fast_hash_fn)
+        shard, hash = hr.assign("key")
+        self.assertEqual(hr.assign("key"), (shard, hash))
+        self.assertEqual(hr.hash("key"), fast_hash_fn("key", 2**64))
+        other = 'shard2' if shard == 'shard1' else 'shard1'
+        names = hr.shard_names
+        self.assertEqual(hr.remove_shard(shard), fast_hash_fn(shard, 2**64))
+        # the old ring is left as it was for readers still holding it
+        self.assertEqual(names, ['shard1', 'shard2'])
+        self.assertEqual(hr.assign("key"), (other, hash))
+
+        count = {}
+        hr.rebuild(['shard1', 'shard2', 'shard3', 'shard4'])
+        for shard, keys in hr.assign_many("key" + str(i) for i in range(10000)).items():
+            count[shard] = len(keys)
+        self.assertEqual(len(count), 4)
+        self.assertGreater(min(count.values()), 1500)
+
+
 if __name__ == '__main__':
     shards = ['shard1', 'shard2', 'shard3', 'shard4']
     #shards2 = ['shard1', 'shard3']
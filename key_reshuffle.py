@@ -1,6 +1,8 @@
 import requests
 import json
 import math
+import unittest
+from bisect import bisect_right
 
 from consistent_hashing import HashRing
 from kvs import Kvs, KvsNode
@@ -15,6 +17,8 @@ from kvs import Kvs, KvsNode
 
 
 ViewType = dict[str, list[str]]
+# hashes in [start, end) move from the first shard to the second
+Move = tuple[int, int, str, str]
 
 def generateEmptyView(nShards: int) -> ViewType:
     return {f"shard{i}": [] for i in range(nShards)}
@@ -165,4 +169,57 @@ def add_shards(num_old_shards: int, numshards: int, associated_nodes: dict, hash
 #                 requests.put(url, json={k: data.get(k).asDict()}, timeout=1)
 
 
-
+# which hash ranges change owner between two rings. only positions where either ring has a point can
+# change owner, so walking the points of both rings in order is enough
+def planMigration(old: HashRing, new: HashRing) -> list[Move]:
+    if len(old.keys) == 0 or len(new.keys) == 0:
+        return []
+    assert old.max_hashes == new.max_hashes
+    bounds = sorted(set(old.keys).union(new.keys).union([0]))
+    plan: list[Move] = []
+    for start, end in zip(bounds, bounds[1:] + [old.max_hashes]):
+        fromShard = old.assign_prehashed(start)
+        toShard = new.assign_prehashed(start)
+        if fromShard == toShard:
+            continue
+        if plan and plan[-1][1] == start and plan[-1][2:] == (fromShard, toShard):
+            plan[-1] = (plan[-1][0], end, fromShard, toShard)
+        else:
+            plan.append((start, end, fromShard, toShard))
+    return plan
+
+# the moves leaving one shard, with their starts for finding a hash's move by bisecting
+class MovesFrom:
+    def __init__(self, plan: list[Move], shard: str) -> None:
+        self.moves = [move for move in plan if move[2] == shard]
+        self.starts = [move[0] for move in self.moves]
+
+    # the shard hash moves to, None if it stays
+    def destination(self, hash: int) -> str | None:
+        i = bisect_right(self.starts, hash) - 1
+        if i >= 0 and hash < self.moves[i][1]:
+            return self.moves[i][3]
+        return None
+
+class PlannerTests(unittest.TestCase):
+    def testAddShard(self):
+        old = HashRing.fromShards([f"shard{i}" for i in range(4)], 2**64, 200)
+        new = HashRing.fromShards([f"shard{i}" for i in range(5)], 2**64, 200)
+        plan = planMigration(old, new)
+        self.assertTrue(all(move[3] == "shard4" for move in plan))
+        moved = sum(end - start for start, end, _, _ in plan) / 2**64
+        self.assertLess(abs(moved - 0.2), 0.05)
+
+        for i in range(2000):
+            key = f"key{i}"
+            fromShard, hash = old.assign(key)
+            toShard = new.assign(key)[0]
+            destination = MovesFrom(plan, fromShard).destination(hash)
+            self.assertEqual(destination, None if fromShard == toShard else toShard)
+
+    def testSameRing(self):
+        ring = HashRing.fromShards(["a", "b"], 2**64, 50)
+        self.assertEqual(planMigration(ring, HashRing.fromShards(["b", "a"], 2**64, 50)), [])
+
+if __name__ == "__main__":
+    unittest.main()
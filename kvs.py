@@ -1,13 +1,29 @@
+import os
 import unittest
+import tempfile
+import asyncio
+import json
+from threading import Lock, RLock
 
-from operations import Operation, OperationGenerator
+from operations import Operation, OperationGenerator, CausalContext
+from merkle import BucketMerkleTree, Payload
+from sorted_index import SortedIndex
+from storage import Storage
+from concurrent.futures import Future
+from itertools import islice
+from time import monotonic
+from typing import Callable, Iterator
+from consistent_hashing import hash_fn
 
 
 class KvsNode:
-    def __init__(self, value, *, operation: Operation, msSinceEpoch: int, dependencies: list[Operation] = []) -> None:
-        if dependencies:
-            assert type(dependencies[0]) == Operation
-        dependencies.append(operation)
+    __slots__ = ("value", "operation", "timestamp", "dependencies")
+
+    # the node owns dependencies, its own operation is added to them
+    def __init__(self, value, *, operation: Operation, msSinceEpoch: int, dependencies: CausalContext | None = None) -> None:
+        if dependencies is None:
+            dependencies = CausalContext()
+        dependencies.add(operation)
         self.value = value
         self.operation = operation
         self.timestamp = msSinceEpoch
@@ -17,7 +33,7 @@ class KvsNode:
         return {
             "value": self.value,
             "timestamp": self.timestamp,
-            "dependencies": list(map(repr, self.dependencies)),
+            "dependencies": self.dependencies.asDict(),
             "operation": repr(self.operation),
         }
     def fromDict(d: dict) -> "KvsNode":
@@ -27,23 +43,22 @@ class KvsNode:
             d["value"], 
             operation=Operation.fromString(d["operation"]),
             msSinceEpoch=d["timestamp"], 
-            dependencies=[*map(Operation.fromString, d["dependencies"])]
+            dependencies=CausalContext.fromDict(d["dependencies"])
         )
     def dependsOn(self, other: "KvsNode"):
-        if other.operation in self.dependencies:
-            return True
-        return False
+        return self.dependencies.covers(other.operation)
         
 
 #only used for never seen before keys, use None as value for deleted keys!
 class EmptyKvsNode(KvsNode):
     def __init__(self) -> None:
         self.uninit = True
-        self.dependencies = []
+        self.value = None
+        self.dependencies = CausalContext()
     def asDict(self) -> dict:
         return {
             "uninit": True,
-            "dependencies": []
+            "dependencies": {}
         }
     def fromDict(d: dict):
         raise Exception("dont do this")
@@ -53,6 +68,10 @@ class EmptyKvsNode(KvsNode):
 
 EMPTY_NODE = EmptyKvsNode()
 
+# seconds a purged key's stable clock is kept, so copies of its tombstone still in flight or on
+# replicas that compact later are rejected instead of stored again
+FORGET_AFTER = 60
+
 def getLargerNode(a: KvsNode, b: KvsNode) -> KvsNode:
     if a.dependsOn(b):
         return a
@@ -67,50 +86,411 @@ def getLargerNode(a: KvsNode, b: KvsNode) -> KvsNode:
     if b.operation.name > a.operation.name:
         return b
     assert a.value == b.value, "logic error in code: we shouldnt be here right?"
-    assert len(a.dependencies) == len(b.dependencies), "logic error in code: we shouldnt be here right?"
+    assert a.operation == b.operation, "logic error in code: we shouldnt be here right?"
     return a
 
 
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
 class Kvs:
-    def __init__(self) -> None:
+    # with storage every change is logged and the store starts from what is on disk.
+    # ringHash is the key's position on the hash ring, the default matches a HashRing(2**64, ...)
+    def __init__(self, storage: Storage | None = None, ringHash: Callable[[str], int] = lambda key: hash_fn(key, 2**64)) -> None:
         self._data: dict[str, KvsNode] = {}
-        self._opsSeen: set[str] = set()
+        # held while a key's stored node is chosen or purged, so a purge never removes a newer write
+        self._lock = RLock()
+        # for every key, the operations that are in or superseded by what we store
+        self._seen = CausalContext()
+        # operations every replica of the shard has seen, learned through gossip. they are dropped
+        # from _seen and from stored dependencies and always count as seen. one clock per stored
+        # key, a purged key's clock stays FORGET_AFTER longer to keep its old writes from coming back
+        self._stable = CausalContext()
+        self._seenLock = RLock()
+        # key -> version of its last change to _seen, oldest first, so peers can be sent only what changed.
+        # keys whose seen operations all became stable are dropped, every peer has them already
+        self._changes: dict[str, int] = {}
+        # the same as (version, key), so a peer's delta starts at its acked version instead of the newest change
+        self._changeOrder = SortedIndex()
+        self._version = 0
+        self._gcKeys: list[str] = []
+        # keys whose stored node is a tombstone, oldest first
+        self._tombstones: dict[str, None] = {}
+        # key -> when its tombstone was purged, oldest first, its stable clock is dropped FORGET_AFTER later
+        self._purged: dict[str, float] = {}
+        # replay stores what was stored before, even if it became stable since
+        self._recovering = False
+        # key -> readers waiting for an operation on it, woken by put
+        self._waiters: dict[str, list[tuple[Operation, asyncio.AbstractEventLoop, asyncio.Future]]] = {}
+        # kept up to date on every write so gossip never has to rebuild it
+        self._merkle = BucketMerkleTree()
+        self._merkleLock = Lock()
+        # live keys in order, for paging through them without copying every key
+        self._index = SortedIndex()
+        # the same keys as (ring position, key), so a hash range is a slice of it
+        self._ringIndex = SortedIndex()
+        self._ringHash = ringHash
+        self._indexLock = Lock()
+        self._storage = storage
+        if storage is not None:
+            self._recover()
 
+    # live keys, tombstones are not counted
     def __len__(self):
-        return len(self.get_all_keys())
-
-    def opsSeen(self) -> set[str]:
-        return self._opsSeen
-    #always works, returns true if key is new
-    def put(self, key:str, node: KvsNode) -> bool:
-        self._opsSeen.add(repr(node.operation))
-        if key in self._data:
-            wasDelete = self._data[key].value == None
-            better = getLargerNode(node, self._data[key])
-            self._data[key] = better
-            return wasDelete if better.value != None else False
-        self._data[key] = node
-        return True
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        return self.liveKeys()
+
+    def tombstones(self) -> int:
+        return len(self._tombstones)
+
+    def opsSeen(self) -> CausalContext:
+        return self._seen
+
+    def covered(self, op: Operation) -> bool:
+        return self._stable.covers(op) or self._seen.covers(op)
+
+    # operations on key that context depends on and we have not seen yet
+    def missing(self, key: str, context: CausalContext) -> list[Operation]:
+        return [op for op in context.forKey(key) if not self.covered(op)]
+
+    # everything we have seen on key, stable or not
+    def frontier(self, key: str) -> dict[str, int]:
+        with self._seenLock:
+            clock = dict(self._stable.clock(key))
+            for name, n in self._seen.clock(key).items():
+                if clock.get(name, -1) < n:
+                    clock[name] = n
+            return clock
+
+    # frontiers of up to limit keys changed after version, and the version to ask from next time
+    def seenSince(self, version: int, limit: int) -> tuple[CausalContext, int]:
+        with self._seenLock:
+            changes = list(islice(self._changeOrder.irange((version + 1, "")), limit))
+            if not changes:
+                return CausalContext(), version
+            return CausalContext({key: self.frontier(key) for _, key in changes}), changes[-1][0]
+
+    def markStable(self, key: str, clock: dict[str, int]):
+        self._log({"stable": key, "clock": clock})
+        self._markStable(key, clock)
+
+    def _markStable(self, key: str, clock: dict[str, int]):
+        with self._seenLock:
+            self._stable.mergeClock(key, clock)
+            stable = self._stable.clock(key)
+            seen = {name: n for name, n in self._seen.clock(key).items() if stable.get(name, -1) < n}
+            if seen:
+                self._seen.vv[key] = seen
+            else:
+                self._seen.vv.pop(key, None)
+                self._changeDone(key)
+            self._wake(key)
+
+    def _changeDone(self, key: str):
+        version = self._changes.pop(key, None)
+        if version is not None:
+            self._changeOrder.discard((version, key))
+
+    def prune(self, context: CausalContext) -> CausalContext:
+        return context.pruned(self._stable)
+
+    # drops stable dependencies from up to limit stored nodes, a full pass takes several calls
+    def collectGarbage(self, limit: int):
+        if not self._gcKeys:
+            self._gcKeys = list(self._data)
+        batch = self._gcKeys[-limit:]
+        del self._gcKeys[-limit:]
+        for key in batch:
+            node = self._data.get(key)
+            if node is None:
+                continue
+            dependencies = node.dependencies.pruned(self._stable)
+            dependencies.add(node.operation)
+            node.dependencies = dependencies
+
+    # forgets up to limit tombstones once every operation any replica has seen on their key is stable.
+    # the tombstone being stable is not enough, a concurrent write it won against may still be on its
+    # way and would be stored as live once the tombstone is gone. settled(key, stable clock) tells
+    # whether everything the other replicas reported on key is covered by the stable clock
+    def compactTombstones(self, limit: int, settled: Callable[[str, dict[str, int]], bool] = lambda key, stable: True, forgetAfter: float = FORGET_AFTER) -> int:
+        compacted = 0
+        for key in list(islice(self._tombstones, limit)):
+            # a put between the check and the purge would otherwise be purged with the tombstone
+            with self._lock:
+                node = self._data.get(key)
+                if node is None or node.value != None:
+                    self._tombstones.pop(key, None)
+                    continue
+                stable = self._stable.clock(key)
+                if not self._stable.covers(node.operation) or self._seen.clock(key) or not settled(key, stable):
+                    # not stable yet, check the next ones first
+                    self._tombstones[key] = self._tombstones.pop(key)
+                    continue
+                self._purge(key, node)
+                self._log({"purge": key, "operation": repr(node.operation)})
+                self._purged[key] = monotonic()
+            compacted += 1
+        self._forgetPurged(monotonic() - forgetAfter)
+        return compacted
+
+    # drops the stable clocks of keys purged before cutoff that were not written again since
+    def _forgetPurged(self, cutoff: float):
+        for key, purged in list(self._purged.items()):
+            if purged > cutoff:
+                break
+            del self._purged[key]
+            with self._lock:
+                if key not in self._data:
+                    self._log({"forget": key})
+                    self._forget(key)
+
+    def _forget(self, key: str):
+        with self._seenLock:
+            if key not in self._data and not self._seen.clock(key):
+                self._stable.vv.pop(key, None)
+
+    def _purge(self, key: str, node: KvsNode):
+        with self._lock:
+            if self._data.get(key) is not node:
+                return
+            del self._data[key]
+            self._tombstones.pop(key, None)
+            with self._merkleLock:
+                self._merkle.remove(key)
+
+    # resolves once op is covered. readers may live on other threads' loops, so they are woken threadsafe
+    def waitFor(self, op: Operation) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._seenLock:
+            if self.covered(op):
+                future.set_result(True)
+            else:
+                self._waiters.setdefault(op.key, []).append((op, loop, future))
+        return future
+
+    def stopWaiting(self, key: str, futures: list[asyncio.Future]):
+        with self._seenLock:
+            waiting = [w for w in self._waiters.get(key, []) if w[2] not in futures]
+            if waiting:
+                self._waiters[key] = waiting
+            else:
+                self._waiters.pop(key, None)
+
+    def _wake(self, key: str):
+        with self._seenLock:
+            waiting = self._waiters.get(key)
+            if not waiting:
+                return
+            still = []
+            for op, loop, future in waiting:
+                if not self.covered(op):
+                    still.append((op, loop, future))
+                    continue
+                try:
+                    loop.call_soon_threadsafe(_resolve, future)
+                except RuntimeError:
+                    pass # the reader's loop is already closed
+            if still:
+                self._waiters[key] = still
+            else:
+                del self._waiters[key]
+
+    # returns true if key is new, false if it replaced something and None if node's operation
+    # is stable already, so what we store was chosen over it before
+    def put(self, key:str, node: KvsNode) -> bool | None:
+        with self._lock:
+            isNew = self._store(key, node)
+            if self._data.get(key) is node:
+                self._log({"key": key, "node": node.asDict()})
+        # only now the node is readable
+        self._wake(key)
+        return isNew
+
+    def _store(self, key:str, node: KvsNode) -> bool | None:
+        with self._lock:
+            if self._stable.covers(node.operation) and not self._recovering:
+                # every replica has seen it already, what we store (or a compacted tombstone) was chosen over it
+                return None
+            if self._stable.vv:
+                node.dependencies = node.dependencies.pruned(self._stable)
+                node.dependencies.add(node.operation)
+            if key in self._data:
+                old = self._data[key]
+                if node.operation == old.operation:
+                    isNew = False
+                else:
+                    wasDelete = old.value == None
+                    better = getLargerNode(node, old)
+                    self._data[key] = better
+                    if better is not old:
+                        self._replaced(key, better)
+                    isNew = wasDelete if better.value != None else False
+            else:
+                self._data[key] = node
+                self._replaced(key, node)
+                isNew = True
+            # only after the node is stored, a reader that finds an operation seen reads its node or a later one
+            with self._seenLock:
+                # a node supersedes everything it depends on for its own key
+                self._seen.mergeClock(key, node.dependencies.clock(key))
+                self._version += 1
+                self._changeDone(key)
+                self._changes[key] = self._version
+                self._changeOrder.add((self._version, key))
+            return isNew
+
+    def _replaced(self, key: str, node: KvsNode):
+        position = (self._ringHash(key), key)
+        with self._indexLock:
+            if node.value == None:
+                self._tombstones[key] = None
+                if self._index.discard(key):
+                    self._ringIndex.discard(position)
+            else:
+                self._tombstones.pop(key, None)
+                if self._index.add(key):
+                    self._ringIndex.add(position)
+        self._updateMerkle(key, node)
+
+    # tombstones are in the tree too so deletes spread through gossip
+    def _updateMerkle(self, key: str, node: KvsNode):
+        with self._merkleLock:
+            # pruning changes the dependencies but not which write this is
+            identity = f"{node.operation!r}:{node.value is None}"
+            self._merkle.insert(Payload(key, None, identity))
+
+    def merkleSnapshot(self) -> BucketMerkleTree:
+        with self._merkleLock:
+            return self._merkle.snapshot()
     
     def get(self, key:str) -> KvsNode | EmptyKvsNode:
         if key in self._data and self._data[key].value != None:
             return self._data[key]
         return EMPTY_NODE
+
+    # key's node as sent to other replicas. its dependencies no longer list stable operations, so the
+    # key's stable clock goes along for replicas that never learned it. None if nothing is stored
+    def shipped(self, key: str) -> dict | None:
+        node = self._data.get(key)
+        if node is None:
+            return None
+        d = node.asDict()
+        with self._seenLock:
+            stable = self._stable.clock(key)
+            if stable:
+                d["stable"] = dict(stable)
+        return d
+
+    # stores a node from shipped, the operations stable at the sender count as seen here too
+    def putShipped(self, key: str, d: dict) -> bool | None:
+        isNew = self.put(key, KvsNode.fromDict(d))
+        stable = d.get("stable")
+        if stable:
+            with self._seenLock:
+                known = self._stable.clock(key)
+                if any(known.get(name, -1) < n for name, n in stable.items()):
+                    self.markStable(key, stable)
+        return isNew
+
+    # what gossip ships for key, serialized only when a difference is found
+    def nodeJson(self, key: str) -> str | None:
+        shipped = self.shipped(key)
+        return None if shipped is None else json.dumps(shipped)
+
+    # like get but also returns tombstones
+    def node(self, key: str) -> KvsNode | EmptyKvsNode:
+        return self._data.get(key, EMPTY_NODE)
     
-    # return true on success
-    def delete(self, key: str) -> bool:
-        if key in self._data:
-            self._data[key].value = None
-            return True
-        else:
-            return False
-    
+
+    def _log(self, record: dict):
+        if self._storage is not None:
+            self._storage.append(record)
+
+    # resolves once every change made so far is on disk
+    def synced(self) -> Future:
+        if self._storage is None:
+            future = Future()
+            future.set_result(True)
+            return future
+        return self._storage.synced()
+
+    # replays the snapshot and log without logging them again. records merge like gossip does,
+    # so their order does not matter
+    def _recover(self):
+        self._recovering = True
+        for record in self._storage.records():
+            if "stable" in record:
+                self._markStable(record["stable"], record["clock"])
+            elif "forget" in record:
+                self._forget(record["forget"])
+            elif "purge" in record:
+                # only the tombstone that was compacted, a later write may be in the snapshot already
+                node = self._data.get(record["purge"])
+                if node is not None and repr(node.operation) == record["operation"]:
+                    self._purge(record["purge"], node)
+            else:
+                self._store(record["key"], KvsNode.fromDict(record["node"]))
+        self._recovering = False
+        # nodes replayed after their key became stable brought the stable operations back into _seen
+        for key in list(self._stable.vv):
+            self._markStable(key, {})
+            if key not in self._data:
+                # purged before the restart, its clock is dropped a full FORGET_AFTER from now
+                self._purged[key] = monotonic()
+        self._storage.attach(self._dump)
+
+    # every record needed to rebuild the store, for the storage's snapshots
+    def _dump(self):
+        with self._seenLock:
+            stable = self._stable.copy()
+        for key, clock in stable.vv.items():
+            yield {"stable": key, "clock": clock}
+        for key, node in list(self._data.items()):
+            yield {"key": key, "node": node.asDict()}
+
+    def close(self, wipe: bool = False):
+        if self._storage is not None:
+            if wipe:
+                self._storage.destroy()
+            else:
+                self._storage.close()
+
+    # up to limit live keys after cursor in key order, the first ones when cursor is None
+    def keysAfter(self, cursor: str | None, limit: int) -> list[str]:
+        with self._indexLock:
+            return self._index.page(cursor, limit)
+
+    # up to limit live keys with a ring position in [start, end), as (position, key) in ring order.
+    # after is the last pair of the previous page
+    def keysInRange(self, start: int, end: int, after: tuple[int, str] | None, limit: int) -> list[tuple[int, str]]:
+        with self._indexLock:
+            if after is None:
+                found = self._ringIndex.irange((start, ""), (end, ""))
+            else:
+                found = self._ringIndex.irange(after, (end, ""), inclusive=False)
+            return list(islice(found, limit))
+
+    # live keys in key order, read a page at a time so nothing copies the whole keyspace.
+    # keys written behind the cursor while iterating are not seen
+    def liveKeys(self, after: str | None = None, pageSize: int = 1000) -> Iterator[str]:
+        while page := self.keysAfter(after, pageSize):
+            yield from page
+            after = page[-1]
+
+    # the live keys as they are now, later changes do not show up in it. shares the index's chunks
+    # until the index changes them, so taking one does not copy the keys
+    def keysSnapshot(self) -> SortedIndex:
+        with self._indexLock:
+            return self._index.snapshot()
+
     def get_all_keys(self) -> list[str]:
-        l = []
-        for k in list(self._data.keys()):
-            if self._data[k].value != None:
-                l.append(k)
-        return l
+        with self._indexLock:
+            return list(self._index)
 
 class KvsTests(unittest.TestCase):
     def test(self):
@@ -120,29 +500,254 @@ class KvsTests(unittest.TestCase):
         yop1 = OPGEN.nextName("Y")
         yop2 = OPGEN.nextName("Y")
 
-        node1 = KvsNode("foo", msSinceEpoch=3, dependencies=[], operation=xop)
-        node2 = KvsNode("bar", msSinceEpoch=3, dependencies=[], operation=yop1)
-        node3 = KvsNode("bar2", msSinceEpoch=3, dependencies=[yop1], operation=yop2)
+        node1 = KvsNode("foo", msSinceEpoch=3, dependencies=None, operation=xop)
+        node2 = KvsNode("bar", msSinceEpoch=3, dependencies=None, operation=yop1)
+        deps = CausalContext()
+        deps.add(yop1)
+        node3 = KvsNode("bar2", msSinceEpoch=3, dependencies=deps, operation=yop2)
         kvs.put("X", node1)
         kvs.put("Y", node2)
         kvs.put("Y", node3)
         self.assertEqual(kvs.get("X").value, "foo")
         self.assertEqual(kvs.get("Y").value, "bar2")
-    def test(self):
+    # a coordinator's later operation on a key supersedes its earlier ones even without explicit dependencies
+    def testSameCoordinator(self):
         kvs = Kvs()
         OPGEN = OperationGenerator("TEST")
         xop = OPGEN.nextName("X")
         yop1 = OPGEN.nextName("Y")
         yop2 = OPGEN.nextName("Y")
 
-        node1 = KvsNode("foo", msSinceEpoch=3, dependencies=[], operation=xop)
-        node2 = KvsNode("bar", msSinceEpoch=3, dependencies=[], operation=yop1)
-        node3 = KvsNode("bar2", msSinceEpoch=3, dependencies=[], operation=yop2)
+        node1 = KvsNode("foo", msSinceEpoch=3, dependencies=None, operation=xop)
+        node2 = KvsNode("bar", msSinceEpoch=3, dependencies=None, operation=yop1)
+        node3 = KvsNode("bar2", msSinceEpoch=3, dependencies=None, operation=yop2)
         kvs.put("X", node1)
+        kvs.put("Y", node3)
         kvs.put("Y", node2)
-        self.assertRaises(AssertionError, Kvs.put, kvs, "Y", node3)
         self.assertEqual(kvs.get("X").value, "foo")
-        self.assertEqual(kvs.get("Y").value, "bar")
+        self.assertEqual(kvs.get("Y").value, "bar2")
+        self.assertEqual(kvs.missing("Y", node3.dependencies), [])
+        self.assertEqual(kvs.missing("X", node3.dependencies), [])
+
+    def testTombstone(self):
+        kvs = Kvs()
+        OPGEN = OperationGenerator("TEST")
+        put = KvsNode("foo", msSinceEpoch=3, operation=OPGEN.nextName("X"))
+        kvs.put("X", put)
+        tombstone = KvsNode(None, msSinceEpoch=4, dependencies=put.dependencies.copy(), operation=OPGEN.nextName("X"))
+        kvs.put("X", tombstone)
+        kvs.put("X", put)
+        self.assertIs(kvs.get("X"), EMPTY_NODE)
+        self.assertIs(kvs.node("X"), tombstone)
+        self.assertEqual(kvs.get_all_keys(), [])
+
+    def testLongHistory(self):
+        kvs = Kvs()
+        deps = CausalContext()
+        for i in range(1000):
+            deps.add(OperationGenerator(f"OTHER{i % 10}").nextName(f"K{i}"))
+        OPGEN = OperationGenerator("TEST")
+        ops = [OPGEN.nextName("Y") for _ in range(1000)]
+        for op in ops:
+            deps.add(op)
+        first = KvsNode("first", msSinceEpoch=5, operation=ops[0])
+        last = KvsNode("last", msSinceEpoch=1, dependencies=deps, operation=OPGEN.nextName("Y"))
+        self.assertTrue(last.dependsOn(first))
+        self.assertFalse(first.dependsOn(last))
+        kvs.put("Y", last)
+        kvs.put("Y", first)
+        self.assertEqual(kvs.get("Y").value, "last")
+        self.assertEqual(len(last.dependencies.clock("Y")), 1)
+
+    def testWaitFor(self):
+        kvs = Kvs()
+        OPGEN = OperationGenerator("TEST")
+        op = OPGEN.nextName("X")
+        async def read():
+            waiter = kvs.waitFor(op)
+            self.assertFalse(waiter.done())
+            asyncio.get_running_loop().call_later(0.01, kvs.put, "X", KvsNode("foo", msSinceEpoch=3, operation=op))
+            await asyncio.wait_for(waiter, 1)
+            self.assertEqual(kvs.get("X").value, "foo")
+            self.assertTrue(kvs.waitFor(op).done())
+        asyncio.run(read())
+        self.assertEqual(kvs._waiters, {})
+
+    def testStable(self):
+        kvs = Kvs()
+        OPGEN = OperationGenerator("TEST")
+        xop = OPGEN.nextName("X")
+        kvs.put("X", KvsNode("foo", msSinceEpoch=3, operation=xop))
+        deps = CausalContext()
+        deps.add(xop)
+        yop = OPGEN.nextName("Y")
+        node = KvsNode("bar", msSinceEpoch=3, dependencies=deps, operation=yop)
+        kvs.put("Y", node)
+
+        seen, version = kvs.seenSince(0, 10)
+        self.assertEqual(seen.asDict(), {"X": {"TEST": 0}, "Y": {"TEST": 0}})
+        self.assertEqual(kvs.seenSince(version, 10)[0].asDict(), {})
+
+        kvs.markStable("X", {"TEST": 0})
+        self.assertEqual(kvs.opsSeen().clock("X"), {})
+        self.assertEqual(list(kvs._changes), ["Y"])
+        self.assertTrue(kvs.covered(xop))
+        self.assertEqual(kvs.missing("X", deps), [])
+        kvs.collectGarbage(10)
+        self.assertEqual(kvs.node("Y").dependencies.asDict(), {"Y": {"TEST": 0}})
+        self.assertIsNone(kvs.put("X", KvsNode("old", msSinceEpoch=1, operation=xop)))
+
+    # a replica that joins later learns what was pruned from the node's dependencies along with it
+    def testShippedCarriesStable(self):
+        kvs = Kvs()
+        n1, n2 = OperationGenerator("n1"), OperationGenerator("n2")
+        first = n1.nextName("K")
+        kvs.put("K", KvsNode(1, msSinceEpoch=1, operation=first))
+        kvs.put("K", KvsNode(2, msSinceEpoch=2, dependencies=CausalContext({"K": kvs.frontier("K")}), operation=n2.nextName("K")))
+        kvs.markStable("K", {"n1": 0})
+        kvs.collectGarbage(10)
+        self.assertEqual(kvs.node("K").dependencies.asDict(), {"K": {"n2": 0}})
+
+        fresh = Kvs()
+        self.assertTrue(fresh.putShipped("K", json.loads(kvs.nodeJson("K"))))
+        self.assertEqual(fresh.missing("K", CausalContext({"K": {"n1": 0}})), [])
+        self.assertEqual(fresh.get("K").value, 2)
+
+    def testSeenSincePages(self):
+        kvs = Kvs()
+        OPGEN = OperationGenerator("TEST")
+        for key in "ABCDE":
+            kvs.put(key, KvsNode(key, msSinceEpoch=1, operation=OPGEN.nextName(key)))
+        kvs.put("B", KvsNode("b", msSinceEpoch=2, dependencies=CausalContext({"B": kvs.frontier("B")}), operation=OPGEN.nextName("B")))
+        seen, version = kvs.seenSince(0, 2)
+        self.assertEqual(list(seen.vv), ["A", "C"])
+        seen, version = kvs.seenSince(version, 2)
+        self.assertEqual(list(seen.vv), ["D", "E"])
+        seen, version = kvs.seenSince(version, 2)
+        self.assertEqual(list(seen.vv), ["B"])
+        seen, after = kvs.seenSince(version, 2)
+        self.assertEqual((seen.asDict(), after), ({}, version))
+
+    def testRecover(self):
+        with tempfile.TemporaryDirectory() as directory:
+            kvs = Kvs(Storage(directory, snapshotEvery=3))
+            OPGEN = OperationGenerator("TEST")
+            xop = OPGEN.nextName("X")
+            kvs.put("X", KvsNode("foo", msSinceEpoch=3, operation=xop))
+            for i in range(10):
+                kvs.put("Y", KvsNode(i, msSinceEpoch=i, operation=OPGEN.nextName("Y")))
+            kvs.put("Z", KvsNode("z", msSinceEpoch=3, operation=OPGEN.nextName("Z")))
+            kvs.put("Z", KvsNode(None, msSinceEpoch=4, dependencies=kvs.node("Z").dependencies.copy(), operation=OPGEN.nextName("Z")))
+            kvs.markStable("X", {"TEST": 0})
+            kvs.synced().result(5)
+            kvs.close()
+
+            kvs = Kvs(Storage(directory))
+            self.assertEqual(kvs.get("X").value, "foo")
+            self.assertEqual(kvs.get("Y").value, 9)
+            self.assertIs(kvs.get("Z"), EMPTY_NODE)
+            self.assertEqual(kvs.keysAfter(None, 10), ["X", "Y"])
+            self.assertTrue(kvs.covered(xop))
+            self.assertEqual(kvs.opsSeen().clock("X"), {})
+            kvs.close(wipe=True)
+            self.assertEqual(os.listdir(directory), [])
+
+    # a restarted coordinator counts from 0 again, its new incarnation keeps the operations new
+    def testRestartedCoordinator(self):
+        kvs = Kvs()
+        before = OperationGenerator("n1", "first")
+        for i in range(3):
+            kvs.put("K", KvsNode(i, msSinceEpoch=i, dependencies=CausalContext({"K": kvs.frontier("K")}), operation=before.nextName("K")))
+        kvs.markStable("K", kvs.frontier("K"))
+        after = OperationGenerator("n1", "second")
+        self.assertFalse(kvs.put("K", KvsNode(3, msSinceEpoch=3, dependencies=CausalContext({"K": kvs.frontier("K")}), operation=after.nextName("K"))))
+        self.assertEqual(kvs.get("K").value, 3)
+        self.assertIsNone(kvs.put("K", KvsNode(4, msSinceEpoch=4, operation=OperationGenerator("n1", "first").nextName("K"))))
+        self.assertEqual(kvs.get("K").value, 3)
+
+    def testCompactTombstones(self):
+        with tempfile.TemporaryDirectory() as directory:
+            kvs = Kvs(Storage(directory))
+            OPGEN = OperationGenerator("TEST")
+            for key in "XYZ":
+                kvs.put(key, KvsNode(key, msSinceEpoch=3, operation=OPGEN.nextName(key)))
+            put = kvs.node("X")
+            tombstone = KvsNode(None, msSinceEpoch=4, dependencies=put.dependencies.copy(), operation=OPGEN.nextName("X"))
+            kvs.put("X", tombstone)
+            kvs.put("Y", KvsNode(None, msSinceEpoch=4, dependencies=kvs.node("Y").dependencies.copy(), operation=OPGEN.nextName("Y")))
+            self.assertEqual((len(kvs), kvs.tombstones()), (1, 2))
+
+            kvs.markStable("X", kvs.frontier("X"))
+            self.assertEqual(kvs.compactTombstones(10), 1)
+            self.assertEqual(kvs.node("X"), EMPTY_NODE)
+            self.assertEqual((len(kvs), kvs.tombstones()), (1, 1))
+            # the deleted write arriving late through gossip stays deleted
+            self.assertIsNone(kvs.put("X", put))
+            self.assertEqual(kvs.node("X"), EMPTY_NODE)
+            kvs.synced().result(5)
+            kvs.close()
+
+            kvs = Kvs(Storage(directory))
+            self.assertEqual(kvs.node("X"), EMPTY_NODE)
+            self.assertEqual((len(kvs), kvs.tombstones()), (1, 1))
+            self.assertIn("X", kvs._stable.vv)
+            kvs.compactTombstones(10, forgetAfter=0)
+            kvs.synced().result(5)
+            kvs.close()
+
+            kvs = Kvs(Storage(directory))
+            self.assertNotIn("X", kvs._stable.vv)
+            kvs.close()
+
+    # a tombstone that won against a concurrent write is only purged once that write is stable too
+    def testConcurrentWriteOutlivesPurge(self):
+        kvs = Kvs()
+        tombstone = KvsNode(None, msSinceEpoch=5, operation=OperationGenerator("n1").nextName("K"))
+        write = KvsNode("old write", msSinceEpoch=1, operation=OperationGenerator("n2").nextName("K"))
+        kvs.put("K", tombstone)
+        kvs.markStable("K", {"n1": 0})
+        # another replica reported the write, we have not seen it yet
+        self.assertEqual(kvs.compactTombstones(10, lambda key, stable: stable.get("n2", -1) >= 0), 0)
+        kvs.put("K", write)
+        self.assertEqual(kvs.compactTombstones(10), 0)
+        self.assertIs(kvs.get("K"), EMPTY_NODE)
+
+        kvs.markStable("K", {"n1": 0, "n2": 0})
+        self.assertEqual(kvs.compactTombstones(10, lambda key, stable: stable.get("n2", -1) >= 0), 1)
+        self.assertIsNone(kvs.put("K", write))
+        self.assertIs(kvs.get("K"), EMPTY_NODE)
+        # the stable clock goes once nothing can bring the key back any more
+        kvs.compactTombstones(10, forgetAfter=0)
+        self.assertEqual(kvs._stable.asDict(), {})
+        self.assertEqual(kvs._purged, {})
+
+    def testKeysInRange(self):
+        kvs = Kvs(ringHash=lambda key: int(key[1:]) % 10)
+        OPGEN = OperationGenerator("TEST")
+        for i in range(30):
+            kvs.put(f"K{i}", KvsNode(i, msSinceEpoch=3, operation=OPGEN.nextName(f"K{i}")))
+        kvs.put("K13", KvsNode(None, msSinceEpoch=4, dependencies=kvs.node("K13").dependencies.copy(), operation=OPGEN.nextName("K13")))
+        page = kvs.keysInRange(2, 4, None, 3)
+        self.assertEqual(page, [(2, "K12"), (2, "K2"), (2, "K22")])
+        self.assertEqual(kvs.keysInRange(2, 4, page[-1], 3), [(3, "K23"), (3, "K3")])
+        self.assertEqual(kvs.keysInRange(2, 4, (3, "K3"), 3), [])
+
+    def testKeysAfter(self):
+        kvs = Kvs()
+        OPGEN = OperationGenerator("TEST")
+        for key in "DBCA":
+            kvs.put(key, KvsNode(key, msSinceEpoch=3, operation=OPGEN.nextName(key)))
+        kvs.put("C", KvsNode(None, msSinceEpoch=4, dependencies=kvs.node("C").dependencies.copy(), operation=OPGEN.nextName("C")))
+        self.assertEqual(kvs.keysAfter(None, 2), ["A", "B"])
+        self.assertEqual(kvs.keysAfter("B", 2), ["D"])
+        self.assertEqual(kvs.keysAfter("D", 2), [])
+
+        self.assertEqual(list(kvs.liveKeys(pageSize=1)), ["A", "B", "D"])
+        snapshot = kvs.keysSnapshot()
+        kvs.put("E", KvsNode("E", msSinceEpoch=3, operation=OPGEN.nextName("E")))
+        self.assertEqual(list(snapshot), ["A", "B", "D"])
+        self.assertEqual(list(kvs), ["A", "B", "D", "E"])
+        self.assertEqual(len(kvs), 4)
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,10 +1,15 @@
 import unittest
 import hashlib
 import json
+from typing import Callable
+
+from consistent_hashing import hash_fn
 
 
 
 class Node:
+    __slots__ = ("hash",)
+
     def __init__(self, children: list["Node"]) -> None:
         self.hash = 0
         for child in children:
@@ -18,23 +23,39 @@ class Node:
         return json.dumps(self.asObj())
 
 
+# only the key and the hash are kept, the tree lives as long as the store and must not hold a second
+# copy of every value. the value is looked up when a difference is shipped
 class Payload(Node):
-    def __init__(self, key: str, val: str) -> None:
+    __slots__ = ("key",)
+
+    # identity replaces val in the hash when parts of val may differ between replicas holding the same thing
+    def __init__(self, key: str, val: str | None, identity: str | None = None) -> None:
         self.key = key
-        self.val = val
-        self.hash = int.from_bytes(hashlib.sha256( f"{key}:{val}".encode(),usedforsecurity=False ).digest(), 'big')
+        hashed = val if identity is None else identity
+        self.hash = int.from_bytes(hashlib.sha256( f"{key}:{hashed}".encode(),usedforsecurity=False ).digest(), 'big')
     def asHash(self) -> int:
         return self.hash
     def asObj(self):
-        return {"key": self.key, "val": self.val, "hash": self.hash}
+        return {"key": self.key, "hash": self.hash}
     def __repr__(self) -> str:
         return json.dumps(self.asObj())
 
+# leaf of a BucketMerkleTree, holds every payload whose key hashes into its range
+# gen is the tree generation that created it, buckets of older generations may be in a snapshot
+class Bucket(Node):
+    __slots__ = ("payloads", "gen")
+
+    def __init__(self, payloads: dict[str, Payload], hash: int, gen: int = 0) -> None:
+        self.payloads = payloads
+        self.hash = hash
+        self.gen = gen
+
 class MerkleTree:
     def __init__(self) -> None:
         self.N = 2
         self.pyramid: list[list[Node]] = [[]]
         self.size = 0
+        self.index: dict[str, int] = {} # key -> position in pyramid[0]
 
     def __str__(self):
         return str(self.pyramid)
@@ -42,11 +63,54 @@ class MerkleTree:
     def len(self):
         return self.size
 
+    # replaces the leaf in place if the key is already in the tree
     def insert(self, data: Payload):
+        if data.key in self.index:
+            which = self.index[data.key]
+            self.pyramid[0][which] = data
+            self.rehash(which)
+            return
+        self.index[data.key] = len(self.pyramid[0])
         self.size += 1
         self.pyramid[0].append(data)
         self.rehash(len(self.pyramid[0]) - 1)
 
+    # moves the last leaf into the removed slot so only two paths get rehashed
+    def remove(self, key: str) -> bool:
+        which = self.index.pop(key, None)
+        if which is None:
+            return False
+        self.size -= 1
+        leaves = self.pyramid[0]
+        last = leaves.pop()
+        if which < len(leaves):
+            leaves[which] = last
+            self.index[last.key] = which
+        self._shrink()
+        if which < len(leaves):
+            self.rehash(which)
+        if leaves:
+            self.rehash(len(leaves) - 1)
+        return True
+
+    # drops nodes left over from removed leaves: every row holds ceil(len(row below) / N) nodes
+    # and the pyramid ends at the first row with a single node
+    def _shrink(self):
+        for depth in range(len(self.pyramid) - 1):
+            below = self.pyramid[depth]
+            if len(below) <= 1:
+                del self.pyramid[depth + 1:]
+                return
+            del self.pyramid[depth + 1][-(-len(below) // self.N):]
+
+    # read only copy for a gossip round; nodes are never mutated so copying the rows is enough
+    def snapshot(self) -> "MerkleTree":
+        tree = MerkleTree()
+        tree.N = self.N
+        tree.size = self.size
+        tree.pyramid = [row.copy() for row in self.pyramid]
+        return tree
+
     def rehash(self, which: int):     
         for prev,next in zip(self.pyramid[0:-1], self.pyramid[1:]):
             mini = -(which % self.N)
@@ -65,6 +129,8 @@ class MerkleTree:
     def findForComparison(self, row: int, unfoundNodes: list[int] | None) -> tuple[list[int], list[dict[str]]]:
         deeper = []
         info = []
+        if row > 1 and row >= len(self.pyramid):
+            return deeper, info
         if len(self.pyramid) == 1:
             return [], [p.asObj() for p in self.pyramid[0] if not unfoundNodes or p.hash in unfoundNodes]
         if unfoundNodes is not None:
@@ -85,30 +151,209 @@ class MerkleTree:
         
     def root(self) -> Node:
         return self.pyramid[-1][0]
+
+    def allHashes(self):
+        for row in self.pyramid:
+            for node in row:
+                yield node.asHash()
+
+# leaves are a fixed number of buckets over the hash_fn ring, so the shape of the tree only depends on
+# which keys are stored and not on the order they came in. replicas holding the same data have the same
+# interior nodes and a single differing key is found in one round trip per level
+class BucketMerkleTree:
+    def __init__(self, maxHashes: int = 2**64, N: int = 16, depth: int = 3) -> None:
+        self.N = N
+        self.maxHashes = maxHashes
+        self.nBuckets = N ** depth
+        self.size = 0
+        self.where: dict[str, int] = {} # key -> bucket
+        # bumped by every snapshot, buckets from an older generation are copied before they change
+        self.generation = 0
+        self.pyramid: list[list[Node]] = [[Bucket({}, 0) for _ in range(self.nBuckets)]]
+        while len(self.pyramid[-1]) > 1:
+            below = self.pyramid[-1]
+            self.pyramid.append([Node(below[i:i+N]) for i in range(0, len(below), N)])
+
+    def __str__(self):
+        return str(self.pyramid)
+
+    def len(self):
+        return self.size
+
+    def bucketOf(self, key: str) -> int:
+        return hash_fn(key, self.maxHashes) * self.nBuckets // self.maxHashes
+
+    # a bucket is copied the first time it changes after a snapshot, so snapshots never see it change
+    # and writes in between change it in place
+    def _own(self, which: int) -> Bucket:
+        bucket: Bucket = self.pyramid[0][which]
+        if bucket.gen != self.generation:
+            bucket = Bucket(bucket.payloads.copy(), bucket.hash, self.generation)
+            self.pyramid[0][which] = bucket
+        return bucket
+
+    def insert(self, data: Payload):
+        which = self.where.get(data.key)
+        if which is None:
+            which = self.bucketOf(data.key)
+            self.where[data.key] = which
+            self.size += 1
+        bucket = self._own(which)
+        old = bucket.payloads.get(data.key)
+        bucket.hash ^= data.hash if old is None else data.hash ^ old.hash
+        bucket.payloads[data.key] = data
+        self.rehash(which)
+
+    def remove(self, key: str) -> bool:
+        which = self.where.pop(key, None)
+        if which is None:
+            return False
+        self.size -= 1
+        bucket = self._own(which)
+        bucket.hash ^= bucket.payloads.pop(key).hash
+        self.rehash(which)
+        return True
+
+    def rehash(self, which: int):
+        for prev, next in zip(self.pyramid[0:-1], self.pyramid[1:]):
+            which = which // self.N
+            next[which] = Node(prev[which * self.N : (which+1) * self.N])
+
+    def snapshot(self) -> "BucketMerkleTree":
+        self.generation += 1
+        tree = BucketMerkleTree.__new__(BucketMerkleTree)
+        tree.generation = -1
+        tree.N = self.N
+        tree.maxHashes = self.maxHashes
+        tree.nBuckets = self.nBuckets
+        tree.size = self.size
+        tree.where = {}
+        tree.pyramid = [row.copy() for row in self.pyramid]
+        return tree
+
+    def findForComparison(self, row: int, unfoundNodes: list[int] | None) -> tuple[list[int], list[dict[str]]]:
+        deeper, _, info, _ = self.findWithPositions(row, unfoundNodes)
+        return deeper, info
+
+    # same as findForComparison plus where every hash is: its index in the row below for nodes,
+    # its bucket for payloads. trees of the same shape line up position by position
+    def findWithPositions(self, row: int, unfoundNodes: list[int] | None) -> tuple[list[int], list[int], list[dict[str]], list[int]]:
+        deeper, deeperAt = [], []
+        info, infoAt = [], []
+        if row > len(self.pyramid):
+            return deeper, deeperAt, info, infoAt
+        if unfoundNodes is not None:
+            unfoundNodes = set(unfoundNodes)
+        for pos,n in enumerate(self.pyramid[-row]):
+            if (row == 1 and not unfoundNodes) or n.asHash() in unfoundNodes:
+                if row == len(self.pyramid):
+                    for p in n.payloads.values():
+                        info.append(p.asObj())
+                        infoAt.append(pos)
+                else:
+                    for i in range(pos * self.N, (pos+1) * self.N):
+                        deeper.append(self.pyramid[-(row + 1)][i].asObj())
+                        deeperAt.append(i)
+        return deeper, deeperAt, info, infoAt
+
+    # the hashes sent at row that differ from ours at the same position. only a differing bucket's
+    # payload hashes are looked at, so an equal tree costs one row of N hashes
+    def missingAt(self, row: int, hashes: list[int], at: list[int]) -> list[int]:
+        if row < len(self.pyramid):
+            level = self.pyramid[-(row + 1)]
+            return [h for h, pos in zip(hashes, at) if pos >= len(level) or level[pos].asHash() != h]
+        buckets: dict[int, set[int]] = {}
+        missing = []
+        for h, pos in zip(hashes, at):
+            if pos not in buckets:
+                bucket = self.pyramid[0][pos] if pos < self.nBuckets else Bucket({}, 0)
+                buckets[pos] = {p.hash for p in bucket.payloads.values()}
+            if h not in buckets[pos]:
+                missing.append(h)
+        return missing
+
+    def compare(self, us: set[int], other: set[int]) -> set[int]:
+        return other.difference(us)
+
+    def root(self) -> Node:
+        return self.pyramid[-1][0]
+
+    def allHashes(self):
+        for row in self.pyramid:
+            for node in row:
+                yield node.asHash()
+        for bucket in self.pyramid[0]:
+            for payload in bucket.payloads.values():
+                yield payload.asHash()
         
-# only finds elements you don't have that the other has, and NOT vice versa
+# only finds elements you don't have that the other has, and NOT vice versa.
+# lookup gives the current value of a key for the leaves we send, None if it is gone
 class MerkleTreeDifferenceFinder:
-    def __init__(self, merkle: MerkleTree) -> None:
+    def __init__(self, merkle: MerkleTree | BucketMerkleTree, lookup: Callable[[str], str | None] | None = None) -> None:
         self.ourTree = merkle
-        self._initSet()
+        self.lookup = lookup
+        self._ourTreeSet: set[int] | None = None
         self.differences: list[dict] = []
+        # row -> leaf hash -> key of the leaves offered by hash in that row, the same for every peer.
+        # kept per row since a bucket holding one leaf has the same hash as the leaf
+        self.offered: dict[int, dict[int, str]] = {}
+        # payload hashes we told a bucket tree sender we are missing
+        self.requested: set[int] = set()
 
-    def _initSet(self):
-        self.ourTreeSet = set()
-        for row in self.ourTree.pyramid:
-            for node in row:
-                self.ourTreeSet.add(node.asHash())
+    # only a receiving MerkleTree compares against every hash, bucket trees compare by position
+    @property
+    def ourTreeSet(self) -> set[int]:
+        if self._ourTreeSet is None:
+            self._ourTreeSet = set(self.ourTree.allHashes())
+        return self._ourTreeSet
 
+    # leaves are offered by hash first and only the ones the other side is missing are sent with
+    # their values in the next round, a differing bucket costs one value per differing key
     def dumpNextPyramidRow(self, fromRow: int, differences: list[int] | None) -> dict[str, list]:
-        sendHash, sendWhole = self.ourTree.findForComparison(fromRow, differences)
-        return {"nodes": sendHash, "leaves": sendWhole}
+        if isinstance(self.ourTree, BucketMerkleTree):
+            sendHash, sendAt, leaves, leavesAt = self.ourTree.findWithPositions(fromRow, differences)
+        else:
+            (sendHash, leaves), sendAt, leavesAt = self.ourTree.findForComparison(fromRow, differences), None, None
+        if leaves:
+            self.offered.setdefault(fromRow, {}).update((leaf["hash"], leaf["key"]) for leaf in leaves)
+        offered = self.offered.get(fromRow - 1, {})
+        sendWhole = [{"key": offered[h], "hash": h} for h in differences or [] if h in offered]
+        row = {"nodes": sendHash + [leaf["hash"] for leaf in leaves], "leaves": self._withValues(sendWhole)}
+        if sendAt is not None:
+            row.update({"row": fromRow, "at": sendAt + leavesAt})
+            if fromRow == 1:
+                row["root"] = self.ourTree.root().asHash()
+        return row
+
+    def _withValues(self, leaves: list[dict]) -> list[dict]:
+        if self.lookup is None:
+            return leaves
+        withValues = []
+        for leaf in leaves:
+            val = self.lookup(leaf["key"])
+            if val is not None:
+                withValues.append({**leaf, "val": val})
+        return withValues
 
     def compareForDifferences(self, incoming: dict[str, list]) -> list[int]:
+        if "at" in incoming and isinstance(self.ourTree, BucketMerkleTree):
+            return self._compareAt(incoming)
         other = incoming["nodes"]
         self.differences.extend([l for l in incoming["leaves"] if l["hash"] not in self.ourTreeSet])
         diffSet = self.ourTree.compare(self.ourTreeSet, set(other))
         return list(diffSet)
 
+    # bucket trees are compared position by position, nothing is built for the parts that are equal
+    def _compareAt(self, incoming: dict[str, list]) -> list[int]:
+        # every leaf sent was asked for, the snapshot we compare against does not change
+        self.differences.extend(l for l in incoming["leaves"] if l["hash"] in self.requested)
+        if incoming.get("root") == self.ourTree.root().asHash():
+            return []
+        missing = self.ourTree.missingAt(incoming["row"], incoming["nodes"], incoming["at"])
+        if incoming["row"] == len(self.ourTree.pyramid):
+            self.requested.update(missing)
+        return missing
+
     def getResult(self) -> list:
         res = self.differences
         self.differences = []
@@ -198,6 +443,26 @@ class Tests(unittest.TestCase):
             if not diff:
                 break
         self.assertEqual(len(mf2.getResult()), len("qrstuvwxyz"))
+    def testIncremental(self):
+        live = MerkleTree()
+        for l in "abcdefghijklmnop":
+            live.insert(Payload(l, l*10))
+        live.insert(Payload("c", "changed"))
+        live.remove("a")
+        live.remove("p")
+        live.remove("zzz")
+
+        rebuilt = MerkleTree()
+        for l in "bcdefghijklmno":
+            rebuilt.insert(Payload(l, "changed" if l == "c" else l*10))
+        self.assertEqual(live.len(), rebuilt.len())
+        self.assertEqual(live.root().asHash(), rebuilt.root().asHash())
+        self.assertEqual(len(live.pyramid), len(rebuilt.pyramid))
+
+        for l in "bcdefghijklmno":
+            live.remove(l)
+        self.assertEqual(live.pyramid, [[]])
+
     def testDisjoint(self):
         m1 = MerkleTree()
         m2 = MerkleTree()
@@ -220,6 +485,106 @@ class Tests(unittest.TestCase):
                 break
         self.assertEqual(len(mf1.getResult()), len(mf2.getResult()))
     
+    def testBucketOrderIndependent(self):
+        m1 = BucketMerkleTree(N=4, depth=3)
+        m2 = BucketMerkleTree(N=4, depth=3)
+        keys = [str(i) for i in range(200)]
+        for k in keys:
+            m1.insert(Payload(k, k*3))
+        for k in reversed(keys):
+            m2.insert(Payload(k, "old"))
+            m2.insert(Payload(k, k*3))
+        m2.insert(Payload("extra", "x"))
+        m2.remove("extra")
+        self.assertEqual([[n.asHash() for n in row] for row in m1.pyramid], [[n.asHash() for n in row] for row in m2.pyramid])
+
+    def testBucketOneDiff(self):
+        m1 = BucketMerkleTree(N=4, depth=3)
+        m2 = BucketMerkleTree(N=4, depth=3)
+        for i in range(200):
+            m1.insert(Payload(str(i), "v"))
+            m2.insert(Payload(str(200 - i - 1), "v"))
+        m1.insert(Payload("hi", "bye"))
+
+        mf1 = MerkleTreeDifferenceFinder(m1.snapshot())
+        mf2 = MerkleTreeDifferenceFinder(m2.snapshot())
+        row = 1
+        diff = None
+        while True:
+            incoming = mf1.dumpNextPyramidRow(row,diff)
+            diff = mf2.compareForDifferences(incoming)
+            self.assertLessEqual(len(diff), 1)
+            row += 1
+            if not diff:
+                break
+        self.assertLessEqual(row, len(m1.pyramid) + 2)
+        self.assertEqual([d["key"] for d in mf2.getResult()], ["hi"])
+
+    def testOnlyMissingValuesAreSent(self):
+        m1 = BucketMerkleTree(N=2, depth=1)
+        m2 = BucketMerkleTree(N=2, depth=1)
+        for i in range(200):
+            m1.insert(Payload(str(i), "v"))
+            m2.insert(Payload(str(i), "v"))
+        m1.insert(Payload("7", "changed"))
+        mf1 = MerkleTreeDifferenceFinder(m1.snapshot(), lambda key: "value of " + key)
+        mf2 = MerkleTreeDifferenceFinder(m2.snapshot())
+        row, diff, sent = 1, None, 0
+        while True:
+            incoming = mf1.dumpNextPyramidRow(row, diff)
+            sent += len(incoming["leaves"])
+            diff = mf2.compareForDifferences(incoming)
+            row += 1
+            if not diff:
+                break
+        self.assertEqual(sent, 1)
+        self.assertEqual([d["key"] for d in mf2.getResult()], ["7"])
+        # only the differing bucket was looked at
+        self.assertIsNone(mf2._ourTreeSet)
+
+    def testEqualTreesStopAtRoot(self):
+        m1 = BucketMerkleTree(N=4, depth=2)
+        m2 = BucketMerkleTree(N=4, depth=2)
+        for i in range(100):
+            m1.insert(Payload(str(i), "v"))
+            m2.insert(Payload(str(99 - i), "v"))
+        mf2 = MerkleTreeDifferenceFinder(m2.snapshot())
+        self.assertEqual(mf2.compareForDifferences(MerkleTreeDifferenceFinder(m1.snapshot()).dumpNextPyramidRow(1, None)), [])
+        self.assertIsNone(mf2._ourTreeSet)
+
+    def testSnapshotUnchanged(self):
+        live = BucketMerkleTree(N=2, depth=2)
+        for i in range(20):
+            live.insert(Payload(str(i), "v"))
+        snapshot = live.snapshot()
+        before = [[n.asHash() for n in row] for row in snapshot.pyramid]
+        live.insert(Payload("3", "changed"))
+        live.insert(Payload("3", "again"))
+        live.remove("4")
+        self.assertEqual([[n.asHash() for n in row] for row in snapshot.pyramid], before)
+        self.assertIn("4", [k for b in snapshot.pyramid[0] for k in b.payloads])
+
+        rebuilt = BucketMerkleTree(N=2, depth=2)
+        for i in range(20):
+            if i != 4:
+                rebuilt.insert(Payload(str(i), "again" if i == 3 else "v"))
+        self.assertEqual(live.root().asHash(), rebuilt.root().asHash())
+
+    def testShippedValuesAreLookedUp(self):
+        m1 = BucketMerkleTree(N=4, depth=2)
+        m1.insert(Payload("a", "1"))
+        m1.insert(Payload("gone", "2"))
+        values = {"a": "current"}
+        mf1 = MerkleTreeDifferenceFinder(m1, values.get)
+        mf2 = MerkleTreeDifferenceFinder(BucketMerkleTree(N=4, depth=2))
+        row, diff = 1, None
+        while True:
+            diff = mf2.compareForDifferences(mf1.dumpNextPyramidRow(row, diff))
+            row += 1
+            if not diff:
+                break
+        self.assertEqual([(d["key"], d["val"]) for d in mf2.getResult()], [("a", "current")])
+
       #      1
      #  #    2
     ##  ##   3
@@ -1,30 +1,116 @@
 
+import sys
+from uuid import uuid4
+
 #must not be a digit or valid name char
 SEP = "|"
 
+# operations are compared and hashed constantly on the causal path, so they are plain
+# (name, key, n) tuples underneath: coordinator names are interned and counters are ints
 class Operation:
-    def __init__(self, name: str, key: str, n: int | str) -> None:
-        self.name = name
+    __slots__ = ("name", "key", "n")
+
+    def __init__(self, name: str, key: str, n: int) -> None:
+        self.name = sys.intern(name)
         self.key = key
-        self.n = n
+        self.n = int(n)
 
     def __repr__(self) -> str:
         return f"{self.name}{SEP}{self.key}{SEP}{self.n}"
 
     def __eq__(self, __o: object) -> bool:
-        return repr(self) == repr(__o)
+        if not isinstance(__o, Operation):
+            return NotImplemented
+        return self.n == __o.n and self.name is __o.name and self.key == __o.key
+
+    def __hash__(self) -> int:
+        return hash((self.name, self.key, self.n))
 
     #creates an operation from its repr
+    @staticmethod
     def fromString(op: str) -> "Operation":
         arr = op.split(SEP)
         name = arr[0] #first
         n = arr[-1] #last
         key = SEP.join(arr[1:-1]) #everything in the middle
-        return Operation(name, key, n)
+        return Operation(name, key, int(n))
+
+# causal metadata as one version vector per key: key -> coordinator name -> highest counter seen.
+# a coordinator numbers the operations on a key in order, so one entry covers all of its earlier ones
+# and the size grows with the number of coordinators instead of the number of writes
+class CausalContext:
+    def __init__(self, vv: dict[str, dict[str, int]] | None = None) -> None:
+        self.vv = vv if vv is not None else {}
+
+    def add(self, op: Operation):
+        clock = self.vv.setdefault(op.key, {})
+        if clock.get(op.name, -1) < op.n:
+            clock[op.name] = op.n
+
+    def mergeClock(self, key: str, other: dict[str, int]):
+        clock = self.vv.setdefault(key, {})
+        for name, n in other.items():
+            if clock.get(name, -1) < n:
+                clock[name] = n
+
+    def merge(self, other: "CausalContext"):
+        for key, clock in other.vv.items():
+            self.mergeClock(key, clock)
+
+    def clock(self, key: str) -> dict[str, int]:
+        return self.vv.get(key, {})
+
+    # two dict lookups no matter how much history the context summarizes
+    def covers(self, op: Operation) -> bool:
+        clock = self.vv.get(op.key)
+        return clock is not None and clock.get(op.name, -1) >= op.n
+
+    # the latest operation from every coordinator on key
+    def forKey(self, key: str) -> list[Operation]:
+        return [Operation(name, key, n) for name, n in self.clock(key).items()]
+
+    # copy without the entries stable already covers
+    def pruned(self, stable: "CausalContext") -> "CausalContext":
+        vv = {}
+        for key, clock in self.vv.items():
+            stableClock = stable.vv.get(key)
+            if stableClock:
+                clock = {name: n for name, n in clock.items() if stableClock.get(name, -1) < n}
+                if not clock:
+                    continue
+            else:
+                clock = dict(clock)
+            vv[key] = clock
+        return CausalContext(vv)
+
+    def copy(self) -> "CausalContext":
+        return CausalContext({key: dict(clock) for key, clock in self.vv.items()})
+
+    def asDict(self) -> dict[str, dict[str, int]]:
+        return {key: dict(clock) for key, clock in self.vv.items()}
+
+    def fromDict(d: dict) -> "CausalContext":
+        return CausalContext({key: {sys.intern(name): int(n) for name, n in clock.items()} for key, clock in d.items()})
+
+    # what clients send and get back as "causal-metadata"
+    def asMetadata(self) -> dict:
+        return {"vv": self.asDict()}
+
+    def fromMetadata(metadata: dict | None) -> "CausalContext":
+        if not metadata:
+            return CausalContext()
+        return CausalContext.fromDict(metadata.get("vv") or {})
+
+# a fresh token for every start of a process. counters start from 0 again on every start, so the
+# incarnation keeps its operations apart from the ones it handed out before
+def newIncarnation() -> str:
+    return uuid4().hex[:12]
 
 class OperationGenerator:
-    def __init__(self, name: str) -> None:
-        self.name = name
+    def __init__(self, name: str, incarnation: str | None = None) -> None:
+        if incarnation is not None:
+            name = f"{name}~{incarnation}"
+        self.name = sys.intern(name)
         self.keys: dict[int] = {}
     def nextName(self, key: str) -> Operation:
         if key in self.keys:
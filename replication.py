@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from unittest import mock
+from background import Executor, sendAsync
+from kvs import KvsNode
+from operations import OperationGenerator
+
+# a batch is sent as soon as it holds this many updates...
+MAX_BATCH = 256
+# ...or once its oldest update has waited this many seconds
+MAX_DELAY = 0.005
+
+# groups replicated writes per peer into /keys/_batch requests.
+# all state lives on the executor loop, enqueueing is safe from any thread
+class Replicator:
+    def __init__(self, executor: Executor, *, maxBatch: int = MAX_BATCH, maxDelay: float = MAX_DELAY, timeout: float = 1) -> None:
+        self.executor = executor
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.timeout = timeout
+        self.pending: dict[str, list[dict]] = {}
+        self.timers: dict[str, asyncio.TimerHandle] = {}
+        # one batch in flight per peer so the receiver applies them in order
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def put(self, nodes: list[str], key: str, node: KvsNode):
+        # serialize now, the node may be mutated after we return
+        self.enqueue(nodes, {"key": key, "node": node.asDict()})
+
+    def enqueue(self, nodes: list[str], update: dict):
+        self.executor.loop.call_soon_threadsafe(self._enqueue, list(nodes), update)
+
+    def _enqueue(self, nodes: list[str], update: dict):
+        for peer in nodes:
+            batch = self.pending.setdefault(peer, [])
+            batch.append(update)
+            if len(batch) >= self.maxBatch:
+                self._flush(peer)
+            elif peer not in self.timers:
+                self.timers[peer] = self.executor.loop.call_later(self.maxDelay, self._flush, peer)
+
+    def _flush(self, peer: str):
+        timer = self.timers.pop(peer, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(peer, None)
+        if batch:
+            self.executor.loop.create_task(self._send(peer, batch))
+
+    async def _send(self, peer: str, batch: list[dict]):
+        lock = self.locks.setdefault(peer, asyncio.Lock())
+        async with lock:
+            # lost batches are repaired by gossip, same as the old per key broadcasts
+            await sendAsync("PUT", peer, "/keys/_batch", {"updates": batch}, self.timeout)
+
+class Tests(unittest.TestCase):
+    def testBatches(self):
+        executor = Executor()
+        opgen = OperationGenerator("TEST")
+        send = mock.AsyncMock(return_value=("", 200))
+        replicator = Replicator(executor, maxBatch=3, maxDelay=0.05)
+        # waits until the executor loop ran everything enqueued before
+        settle = lambda seconds=0: executor.run(asyncio.sleep(seconds)).result()
+        with mock.patch("replication.sendAsync", send):
+            for key in "abc":
+                replicator.put(["p1", "p2"], key, KvsNode(key, msSinceEpoch=1, operation=opgen.nextName(key)))
+            settle()
+            settle()
+            # full batches go out right away, one per peer
+            self.assertEqual(sorted(c.args[1] for c in send.call_args_list), ["p1", "p2"])
+            self.assertEqual([u["key"] for u in send.call_args_list[0].args[3]["updates"]], ["a", "b", "c"])
+            replicator.put(["p1"], "d", KvsNode("d", msSinceEpoch=1, operation=opgen.nextName("d")))
+            settle()
+            self.assertEqual(send.call_count, 2)
+            # the rest once it waited maxDelay
+            settle(0.1)
+            self.assertEqual(send.call_count, 3)
+            self.assertEqual(send.call_args.args[1:3], ("p1", "/keys/_batch"))
+            self.assertEqual([u["key"] for u in send.call_args.args[3]["updates"]], ["d"])
+
+if __name__ == "__main__":
+    unittest.main()
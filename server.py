@@ -1,7 +1,7 @@
 
-from flask import Flask, request, abort
 import os
 import sys
+import inspect
 import requests
 import pickle
 from time import time
@@ -10,25 +10,50 @@ import asyncio
 import json
 import httpx
 
-from kvs import Kvs, KvsNode, getLargerNode
-from background import Executor, broadcastOne, broadcastAll
-from operations import OperationGenerator, Operation
+from kvs import Kvs, KvsNode, EMPTY_NODE, getLargerNode
+from background import Executor, broadcastOne, broadcastAll, broadcastHedged, broadcastFailover, getPool, sendFrom, ReplicaSelector, SingleFlight
+from replication import Replicator
+from storage import Storage
+from stability import StabilityTracker
+from operations import OperationGenerator, Operation, CausalContext, newIncarnation
 from causal import getData, putData, deleteData
 from consistent_hashing import HashRing
 from typing import Coroutine, Any
-from key_reshuffle import remove_shards, add_shards, solveViewChange 
+from key_reshuffle import remove_shards, add_shards, solveViewChange, planMigration, MovesFrom
 from merkle import MerkleTree, MerkleTreeDifferenceFinder, Payload
 from uuid import uuid1
 
+# SERVER_MODE=asgi serves the same routes from Quart on a single event loop shared with gossip and
+# replication, e.g. `SERVER_MODE=asgi hypercorn server:app`. the default is flask's threaded dev server
+ASGI = os.environ.get('SERVER_MODE') == 'asgi'
+if ASGI:
+    from quart import Quart as Flask, request, abort
+else:
+    from flask import Flask, request, abort
+
 
 # need startup logic when creating a replica (broadcast?)
 NAME = os.environ.get('ADDRESS')  # get IP and port
 if not NAME:  # if no ADDRESS exit with return value '1'
     sys.exit('1')
 PORT = 8080
-DATA = Kvs()
+# DATA_DIR keeps the shard's data on disk, a restarted node starts from it and only gossips the difference
+DATA_DIR = os.environ.get('DATA_DIR')
+
+def openKvs() -> Kvs:
+    # the store indexes keys by their position on our ring
+    return Kvs(Storage(DATA_DIR) if DATA_DIR else None, ringHash=lambda key: hashRing.hash(key))
+
+DATA = openKvs()
 BGE = Executor()
-OPGEN = OperationGenerator(NAME)
+# request handlers send through BGE's pool, flask would otherwise give every request its own
+sendFrom(BGE)
+REPLICATOR = Replicator(BGE)
+SELECTOR = ReplicaSelector()
+FETCHES = SingleFlight(BGE)
+# counters restart at 0 with the process, the incarnation keeps new operations from looking stable.
+# with DATA_DIR it is a counter stored next to the log
+OPGEN = OperationGenerator(NAME, str(Storage.nextIncarnation(DATA_DIR)) if DATA_DIR else newIncarnation())
 
 nodes = [] # hold list of node in the cluster
 operations = []
@@ -38,14 +63,40 @@ current_shard_id = None
 reshuffle = False
 merkleTreeCache: dict[str, MerkleTreeDifferenceFinder] = {}
 hashRing = HashRing(2**64, 2000)
+STABILITY = StabilityTracker()
+# keys moved per /reshuffle request
+RESHUFFLE_CHUNK = int(os.environ.get('RESHUFFLE_CHUNK', 500))
+# how long a view change waits for its keys to be moved before answering, they keep moving afterwards
+RESHUFFLE_WAIT = 5
+reshuffleTask = None
+reshuffleProgress = {"cursor": None, "sent": 0, "done": True}
+# (view, shard id) of the transfer that checks every key, the cursor in reshuffleProgress belongs to it
+reshuffleScan = None
+# keys whose seen operations are sent along with one gossip round
+STABILITY_BATCH = 1000
+# stored nodes whose dependencies are pruned after every gossip round
+GC_BATCH = 1000
 
 app = Flask(__name__)
 
+# flask parses the body right away, quart hands back a coroutine
+async def getJson() -> dict | None:
+    body = request.get_json(silent=True)
+    if inspect.isawaitable(body):
+        body = await body
+    return body
+
+if ASGI:
+    @app.before_serving
+    async def startBackground():
+        BGE.adopt(asyncio.get_running_loop())
+        BGE.run(gossip())
+
 # kvs/admin/view - GET, PUT, DELETE
 @app.route('/kvs/admin/view', methods= ['PUT'])
 async def putview():
     global nodes, initialized
-    myjson = request.get_json(silent=True)
+    myjson = await getJson()
     if (myjson == None):
         return {"error": "bad request"}, 400
     if (myjson.get("nodes") == None):
@@ -106,14 +157,16 @@ def deleteFromViewEndpoint():
 
 
 def delete_node():
-    global initialized, DATA
+    global initialized, DATA, STABILITY
     if not initialized:
         return {"error": "uninitialized"}, 418
 
     nodes.clear()
     associated_nodes.clear()
     hashRing.clear()
-    DATA = Kvs()
+    DATA.close(wipe=True)
+    DATA = openKvs()
+    STABILITY = StabilityTracker()
     initialized = False
     return "", 200
 
@@ -126,83 +179,139 @@ def checkjson(myjson):
 
 @app.route('/update_view', methods= ['PUT'])
 async def update_kvs_view():
-    global DATA, nodes, initialized, associated_nodes, current_shard_id, hashRing, reshuffle
+    global DATA, nodes, initialized, associated_nodes, current_shard_id, hashRing, reshuffle, reshuffleTask
     reshuffle = True
-    d = request.json
+    d = await getJson()
     associated_nodes = d
-    hashRing.clear()
+    oldRing = HashRing.fromShards(hashRing.shard_names, hashRing.max_hashes, hashRing.virtual_shards, hashRing.hasher)
+    oldShardId = current_shard_id
+    hashRing.rebuild(associated_nodes.keys())
     current_shard_id = None
     
     for k,v in associated_nodes.items():
-        hashRing.add_shard(k)
         if NAME in v:
             current_shard_id = k
     if current_shard_id:
         nodes = associated_nodes[current_shard_id].copy()
         nodes.remove(NAME)
-    dataToSend: dict[str, dict[str, dict]] = {}
-    for k in DATA.get_all_keys():
-        shard_id, hash = hashRing.assign(k)
-        if shard_id == current_shard_id:
-            print(shard_id, current_shard_id)
-            continue
-        if shard_id in dataToSend:
-            dataToSend[shard_id].update( {k: DATA.get(k).asDict()} )
-        else:
-            dataToSend[shard_id] = {k: DATA.get(k).asDict()}
-    print("dataToSend=",dataToSend, flush=True)
-    futures: list[Coroutine[Any, Any, tuple[str, int] | None]] = []
-    for shardId, shardData in dataToSend.items():
-        futures.append(asyncio.create_task( broadcastOne(
-            "PUT",
-            associated_nodes[shardId],
-            "/reshuffle",
-            shardData,
-            20,
-        ) ))
-    if futures:
-        done, pending = await asyncio.wait(futures, timeout=5)
-        print("d,p = ", done, pending) #debug
-    # when node is not in any shard -- send keys away before deleting
+    # only the hash ranges that left our shard need to be looked at. a node that changed shards
+    # holds another shard's keys, and an unfinished transfer leaves keys outside this change's
+    # ranges behind, both check all keys
+    moves = None
+    if oldShardId is not None and oldShardId == current_shard_id and reshuffleProgress["done"]:
+        moves = MovesFrom(planMigration(oldRing, hashRing), oldShardId)
+    view = {k: list(v) for k, v in associated_nodes.items()}
+    # the same view again, e.g. resent after a timeout, continues an unfinished scan after its last
+    # acknowledged chunk. the keys before it were already checked against this ring
+    start = None
+    if moves is None and not reshuffleProgress["done"] and reshuffleScan == (view, current_shard_id):
+        start = reshuffleProgress["cursor"]
+    # the transfer routes with the ring of this view even if another view change comes in meanwhile
+    ring = HashRing.fromShards(hashRing.shard_names, hashRing.max_hashes, hashRing.virtual_shards, hashRing.hasher)
+    # keys leaving us are streamed out in the background, we only wait a little for them here
+    if reshuffleTask is not None:
+        reshuffleTask.cancel()
+    reshuffleTask = BGE.run(transferKeys(DATA, view, ring, current_shard_id, moves, start))
+    await asyncio.wait([asyncio.wrap_future(reshuffleTask)], timeout=RESHUFFLE_WAIT)
+    # a node that is not in any shard any more is deleted once its keys are sent away
     if current_shard_id == None:
-        delete_node()
         return "OK", 200
 
     initialized = True
     reshuffle = False
     return "OK", 200
 
+# sends every key that does not belong to shardId any more to its new shard, RESHUFFLE_CHUNK keys at a time.
+# with moves only the ring ranges that left shardId are read, without them every key is assigned again.
+# a chunk is retried until the new shard acknowledges it, progress is kept so a retry never resends
+# what was acknowledged. a full scan starts after the key start. only cancelled by the next view change
+async def transferKeys(data: Kvs, view: dict[str, list[str]], ring: HashRing, shardId: str | None, moves: MovesFrom | None = None, start: str | None = None):
+    global reshuffleScan
+    reshuffleScan = (view, shardId) if moves is None else None
+    reshuffleProgress.update({"cursor": start, "sent": reshuffleProgress["sent"] if start else 0, "done": False})
+    chunks = allKeyChunks(data, ring, shardId, start) if moves is None else movedKeyChunks(data, moves)
+    for cursor, destinations in chunks:
+        sends = []
+        for toShard, shardKeys in destinations.items():
+            chunk = {key: shipped for key in shardKeys if (shipped := data.shipped(key)) is not None and shipped["value"] != None}
+            if chunk:
+                sends.append(sendChunk(view[toShard], chunk))
+        reshuffleProgress["sent"] += sum(await asyncio.gather(*sends))
+        reshuffleProgress["cursor"] = cursor
+    reshuffleProgress["done"] = True
+    if shardId == None:
+        delete_node()
+
+# pages through the live keys as they were when the view changed, later writes already use the new ring.
+# yields the last key read and shard -> keys leaving for it
+def allKeyChunks(data: Kvs, ring: HashRing, shardId: str | None, cursor: str | None = None):
+    snapshot = data.keysSnapshot()
+    while keys := snapshot.page(cursor, RESHUFFLE_CHUNK):
+        cursor = keys[-1]
+        yield cursor, {toShard: shardKeys for toShard, shardKeys in ring.assign_many(keys).items() if toShard != shardId}
+
+# same but only reads the moved ranges through the ring index, small ranges share a chunk
+def movedKeyChunks(data: Kvs, moves: MovesFrom):
+    pending: dict[str, list[str]] = {}
+    count = 0
+    last = None
+    for start, end, _, toShard in moves.moves:
+        after = None
+        while page := data.keysInRange(start, end, after, RESHUFFLE_CHUNK - count):
+            pending.setdefault(toShard, []).extend(key for _, key in page)
+            count += len(page)
+            after = page[-1]
+            last = after[1]
+            if count == RESHUFFLE_CHUNK:
+                yield last, pending
+                pending = {}
+                count = 0
+    if pending:
+        yield last, pending
+
+async def sendChunk(addresses: list[str], chunk: dict[str, dict]) -> int:
+    delay = 0.1
+    while await broadcastOne("PUT", addresses, "/reshuffle", chunk, 20) is None:
+        print("reshuffle chunk not acknowledged by", addresses, "retrying", flush=True)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 5)
+    return len(chunk)
+
+@app.route('/reshuffle', methods=['GET'])
+def reshuffleStatus():
+    return reshuffleProgress, 200
+
+# one chunk of keys moving to our shard, answering acknowledges all of it
 @app.route('/reshuffle', methods=['PUT'])
-def reshuffle_key():
-    data = request.json
+async def reshuffle_key():
+    data = await getJson()
     for d in data.keys():
-        kvs_node = KvsNode.fromDict(data[d])
-        DATA.put(d, kvs_node)
-
-    return "OK"
+        DATA.putShipped(d, data[d])
+    if not await durable():
+        return {"error": "not durable"}, 503
+    return {"applied": len(data)}, 200
 
 # kvs/data/<KEY> - GET, PUT, DELETE
 
 @app.route("/keys/<key>", methods=["GET"])
 def getKey(key):
-    key = DATA.get(key)
-    return key.asDict()
+    return DATA.shipped(key) or EMPTY_NODE.asDict()
 
 @app.route("/keys/<key>", methods=["PUT"])
-def putKey(key):
-    reqDict = request.get_json(silent=True)
+async def putKey(key):
+    reqDict = await getJson()
     assert reqDict
-    node = KvsNode( reqDict["value"],
-        operation=Operation.fromString(reqDict["operation"]),
-        msSinceEpoch=int(reqDict["timestamp"]),
-        dependencies=[*map(Operation.fromString, reqDict["dependencies"])]
-    )
-    DATA.put(key, node)
+    DATA.putShipped(key, reqDict)
     return ":)"
 
-@app.route('/keys/<key>', methods=["DELETE"])
-def delete_key(key):
-    DATA.delete(key)
+# replicated updates grouped by the sender's Replicator, applied in order.
+# deletes arrive as tombstone nodes like every other write
+@app.route("/keys/_batch", methods=["PUT"])
+async def putKeyBatch():
+    reqDict = await getJson()
+    assert reqDict
+    for update in reqDict["updates"]:
+        DATA.put(update["key"], KvsNode.fromDict(update["node"]))
     return ":)"
 
 
@@ -211,17 +320,26 @@ def delete_key(key):
 async def keyEndpoint(key: str):
     if not initialized:
         return {"error": "uninitialized"}, 418
-    if request.get_json(silent=True) == None:
+    body = await getJson()
+    if body == None:
         return {"error": "bad request"}, 400
 
     #get url for every node in correct shard
     shardId, keyHashesTo = hashRing.assign(key)
     addresses = associated_nodes[shardId]
-    proxyData = request.json
+    proxyData = body
     proxyData["timestamp"] = time() * 1000
     proxyData["operation"] = repr(OPGEN.nextName(key))
+    # we are a replica of the key, serve it ourselves and only go over the network if we could not answer.
+    # an error we answered with is final, the read already waited for its dependencies or the write was applied
+    if shardId == current_shard_id:
+        try:
+            return await handleData(request.method, key, proxyData)
+        except Exception as e:
+            print("local request failed, trying replicas:", repr(e), flush=True)
+        addresses = [address for address in addresses if address != NAME]
     print(addresses, flush=True)
-    res = await broadcastOne(request.method, addresses, f"/proxy/data/{key}", proxyData, 20)
+    res = await broadcastHedged(request.method, addresses, f"/proxy/data/{key}", proxyData, 20, SELECTOR)
     if res is None:
         return {"error": "upstream down", "upstream": {"shard_id": shardId, "nodes": [addresses]}}, 503
     return res
@@ -230,75 +348,312 @@ async def keyEndpoint(key: str):
 async def dataRoute(key):
     if not initialized:
         return {"error": "uninitialized"}, 418
-    if request.get_json(silent=True) == None:
+    body = await getJson()
+    if body == None:
         return {"error": "bad request"}, 400
+    return await handleData(request.method, key, body)
 
-    match request.method:
+# applies a proxied request to this replica, body already carries the coordinator's timestamp and operation
+async def handleData(method: str, key: str, body: dict) -> tuple[dict, int]:
+    match method:
         case "GET":
             assert hashRing.assign(key)[0] == current_shard_id
-            res = await getData(key, request.json, nodes=nodes, data=DATA, hashRing=hashRing, associatedNodes=associated_nodes)
+            res = await getData(key, body, nodes=nodes, data=DATA, hashRing=hashRing, associatedNodes=associated_nodes, singleFlight=FETCHES)
             return res
-        case "PUT":
-            res = putData(key, request.json, data=DATA, nodes=nodes, executor=BGE)
+        case "PUT" | "DELETE":
+            res = applyWrite(method, key, body)
+            # acknowledged writes survive a restart, concurrent writes share one fsync
+            if res[1] < 300 and not await durable():
+                return NOT_DURABLE
             return res
-        case "DELETE":
-            return deleteData(key, request.json, data=DATA, nodes=nodes, executor=BGE)
         case _default:
             abort(405)
 
+# applies a proxied PUT or DELETE without waiting for the disk, the caller awaits durable()
+def applyWrite(method: str, key: str, body: dict) -> tuple[dict, int]:
+    if method == "PUT":
+        return putData(key, body, data=DATA, nodes=nodes, replicator=REPLICATOR)
+    return deleteData(key, body, data=DATA, nodes=nodes, replicator=REPLICATOR)
+
+
+# how long a request waits for its write to reach the disk
+SYNC_TIMEOUT = 5
+NOT_DURABLE = ({"error": "write not durable"}, 500)
+
+async def durable() -> bool:
+    try:
+        await asyncio.wait_for(asyncio.wrap_future(DATA.synced()), SYNC_TIMEOUT)
+        return True
+    except (asyncio.TimeoutError, OSError) as e:
+        print("write not durable:", repr(e), flush=True)
+        return False
+
+
+# kvs/batch - many GET, PUT and DELETE operations sharing one causal context.
+# the coordinator sends one sub batch per shard in parallel and merges what comes back
+@app.route("/kvs/batch", methods=["PUT"])
+async def batchEndpoint():
+    if not initialized:
+        return {"error": "uninitialized"}, 418
+    body = await getJson()
+    if body == None or not isinstance(body.get("ops"), list):
+        return {"error": "bad request"}, 400
+    ops = body["ops"]
+    for op in ops:
+        if not isinstance(op, dict) or op.get("method") not in ["GET", "PUT", "DELETE"] or not isinstance(op.get("key"), str):
+            return {"error": "bad request"}, 400
+
+    byShard: dict[str, list[int]] = {}
+    for i, op in enumerate(ops):
+        op["timestamp"] = time() * 1000
+        op["operation"] = repr(OPGEN.nextName(op["key"]))
+        shardId, keyHashesTo = hashRing.assign(op["key"])
+        byShard.setdefault(shardId, []).append(i)
+
+    async def sendShard(shardId: str, indexes: list[int]) -> tuple[str, list[int], dict | None]:
+        subBatch = {"ops": [ops[i] for i in indexes], "causal-metadata": body.get("causal-metadata")}
+        addresses = associated_nodes[shardId]
+        if shardId == current_shard_id:
+            try:
+                return shardId, indexes, await handleBatch(subBatch)
+            except Exception as e:
+                print("local batch failed, trying replicas:", repr(e), flush=True)
+            addresses = [address for address in addresses if address != NAME]
+        # too big to be applied twice, replicas are only tried one after another
+        res = await broadcastFailover("PUT", addresses, "/proxy/batch", subBatch, 20, SELECTOR)
+        if res is None or res[1] != 200:
+            return shardId, indexes, None
+        return shardId, indexes, json.loads(res[0])
+
+    results: list[dict] = [{} for _ in ops]
+    context = CausalContext.fromMetadata(body.get("causal-metadata"))
+    for shardId, indexes, res in await asyncio.gather(*[sendShard(shardId, indexes) for shardId, indexes in byShard.items()]):
+        if res is None:
+            for i in indexes:
+                results[i] = {"key": ops[i]["key"], "status": 503, "error": "upstream down", "upstream": {"shard_id": shardId}}
+            continue
+        for i, result in zip(indexes, res["results"]):
+            results[i] = result
+        context.merge(CausalContext.fromMetadata(res["causal-metadata"]))
+    return {"results": results, "causal-metadata": context.asMetadata()}, 200
+
+@app.route("/proxy/batch", methods=["PUT"])
+async def batchRoute():
+    if not initialized:
+        return {"error": "uninitialized"}, 418
+    body = await getJson()
+    if body == None:
+        return {"error": "bad request"}, 400
+    return await handleBatch(body), 200
+
+# applies a sub batch on this replica, the writes in order and then the reads side by side, so one
+# read waiting for its dependencies does not hold up the rest. every operation depends on the batch's
+# context, not on the operations before it, the contexts they return are merged
+async def handleBatch(body: dict) -> dict:
+    metadata = body.get("causal-metadata")
+    context = CausalContext.fromMetadata(metadata)
+    ops = body["ops"]
+    replies: list[tuple[dict, int] | None] = [None] * len(ops)
+    reads: dict[int, Coroutine] = {}
+    for i, op in enumerate(ops):
+        request = {"causal-metadata": metadata, "timestamp": op["timestamp"], "operation": op["operation"], "val": op.get("val")}
+        if op["method"] == "GET":
+            reads[i] = handleData("GET", op["key"], request)
+        else:
+            replies[i] = applyWrite(op["method"], op["key"], request)
+    readsDone = asyncio.gather(*reads.values())
+    # one fsync covers every write of the sub batch
+    written = [i for i, reply in enumerate(replies) if reply is not None and reply[1] < 300]
+    if written and not await durable():
+        for i in written:
+            replies[i] = NOT_DURABLE
+    for i, reply in zip(reads, await readsDone):
+        replies[i] = reply
+    results = []
+    for op, (res, code) in zip(ops, replies):
+        result = {"key": op["key"], "status": code}
+        result.update((k, v) for k, v in res.items() if k != "causal-metadata")
+        results.append(result)
+        if "causal-metadata" in res:
+            context.merge(CausalContext.fromMetadata(res["causal-metadata"]))
+    return {"results": results, "causal-metadata": context.asMetadata()}
 
 # kvs/data - GETs
+# ?limit=n returns one page of at most n scanned keys and a "next-cursor" to pass as ?cursor= for the
+# next one, it is null after the last page. ?format=ndjson streams one key per line and the summary last.
+# ?count-only=true leaves out the keys. ?scope=cluster lists every shard instead of ours, it can not be paged
 @app.route("/kvs/data", methods=["GET"])
 async def get_keys():
     if not initialized:
         return {"error": "uninitialized"}, 418
-    if request.get_json(silent=True) == None:
+    body = await getJson()
+    if body == None:
+        return {"error": "bad request"}, 400
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit")
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            return {"error": "bad request"}, 400
+        limit = int(limit)
+    countOnly = request.args.get("count-only") in ["1", "true"]
+    scope = request.args.get("scope", "shard")
+    if scope not in ["shard", "cluster"] or scope == "cluster" and (cursor is not None or limit is not None):
         return {"error": "bad request"}, 400
-    new_keys = []
-    metadata = request.json['causal-metadata']
-    operations = set()
-    if "ops" in metadata:
-        operations = set(metadata["ops"])
 
+    if request.args.get("format") == "ndjson":
+        if scope == "cluster":
+            lines = streamClusterKeys(body, countOnly)
+        else:
+            lines = streamKeys(body, cursor, limit, countOnly)
+        if not ASGI:
+            lines = BGE.iterate(lines)
+        return app.response_class(lines, mimetype="application/x-ndjson")
+    if scope == "cluster":
+        return await clusterKeys(body, countOnly)
+    return await shardKeys(body, cursor, limit, countOnly)
+
+async def shardKeys(body: dict, cursor: str | None, limit: int | None, countOnly: bool) -> tuple[dict, int]:
+    new_keys = []
     count = 0
-    for key in DATA.get_all_keys():
-        if hashRing.assign(key)[0] != current_shard_id:
-            continue
-        res, code = await getData(key, request.json, nodes=nodes, data=DATA, hashRing=hashRing, associatedNodes=associated_nodes)
-        if code == 500:
-            return res
-        if code == 200:
-            count += 1
-            new_keys.append(key)
-            operations.update(res.get('causal-metadata', {}).get("ops", []))
-    return {
+    context = CausalContext.fromMetadata(body.get('causal-metadata'))
+    nextCursor = None
+    async for nextCursor, results in checkedPages(body, cursor, limit):
+        for key, res, code in results:
+            if code == 500:
+                return res, code
+            if code == 200:
+                count += 1
+                if not countOnly:
+                    new_keys.append(key)
+                context.merge(CausalContext.fromMetadata(res.get('causal-metadata')))
+    res = {
         'shard_id': current_shard_id,
         "count" : count,
-        "keys" : new_keys,
-        "causal-metadata" : {"ops": list(operations)}
-    }, 200
-
-
-async def sendGossip(toNode:str, content: dict, uuid: str) -> list[int]:
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.put(f"http://{toNode}/gossip",json={"data": content, "id": uuid}, timeout=2)
-            res: list = response.json()
-        except httpx.TimeoutException:
-            res = []
-        return res
+        "causal-metadata" : context.asMetadata(),
+        "next-cursor": nextCursor,
+    }
+    if not countOnly:
+        res["keys"] = new_keys
+    return res, 200
+
+async def streamKeys(body: dict, cursor: str | None, limit: int | None, countOnly: bool):
+    count = 0
+    context = CausalContext.fromMetadata(body.get('causal-metadata'))
+    nextCursor = None
+    async for nextCursor, results in checkedPages(body, cursor, limit):
+        lines = []
+        for key, res, code in results:
+            if code == 500:
+                yield json.dumps(res) + "\n"
+                return
+            if code == 200:
+                count += 1
+                if not countOnly:
+                    lines.append(json.dumps({"key": key}) + "\n")
+                context.merge(CausalContext.fromMetadata(res.get('causal-metadata')))
+        if lines:
+            yield "".join(lines)
+    yield json.dumps({"shard_id": current_shard_id, "count": count, "causal-metadata": context.asMetadata(), "next-cursor": nextCursor}) + "\n"
+
+# one shard's listing, from ourselves or from one healthy replica of it
+async def fetchShardKeys(shardId: str, body: dict, countOnly: bool) -> tuple[str, dict | None]:
+    if shardId == current_shard_id:
+        res, code = await shardKeys(body, None, None, countOnly)
+        return shardId, res if code == 200 else None
+    endpoint = "/kvs/data?count-only=true" if countOnly else "/kvs/data"
+    res = await broadcastFailover("GET", associated_nodes[shardId], endpoint, body, 20, SELECTOR)
+    if res is None or res[1] != 200:
+        return shardId, None
+    return shardId, json.loads(res[0])
+
+async def clusterKeys(body: dict, countOnly: bool) -> tuple[dict, int]:
+    keys = []
+    shards = {}
+    context = CausalContext.fromMetadata(body.get('causal-metadata'))
+    for shardId, res in await asyncio.gather(*[fetchShardKeys(shardId, body, countOnly) for shardId in associated_nodes]):
+        if res is None:
+            return {"error": "upstream down", "upstream": {"shard_id": shardId, "nodes": associated_nodes[shardId]}}, 503
+        shards[shardId] = res["count"]
+        keys += res.get("keys", [])
+        context.merge(CausalContext.fromMetadata(res["causal-metadata"]))
+    res = {"count": sum(shards.values()), "shards": shards, "causal-metadata": context.asMetadata()}
+    if not countOnly:
+        res["keys"] = keys
+    return res, 200
+
+# sends every shard's keys as soon as that shard answers
+async def streamClusterKeys(body: dict, countOnly: bool):
+    shards = {}
+    context = CausalContext.fromMetadata(body.get('causal-metadata'))
+    for fetch in asyncio.as_completed([fetchShardKeys(shardId, body, countOnly) for shardId in associated_nodes]):
+        shardId, res = await fetch
+        if res is None:
+            yield json.dumps({"error": "upstream down", "upstream": {"shard_id": shardId, "nodes": associated_nodes[shardId]}}) + "\n"
+            return
+        shards[shardId] = res["count"]
+        context.merge(CausalContext.fromMetadata(res["causal-metadata"]))
+        lines = [json.dumps({"key": key, "shard_id": shardId}) + "\n" for key in res.get("keys", [])]
+        if lines:
+            yield "".join(lines)
+    yield json.dumps({"count": sum(shards.values()), "shards": shards, "causal-metadata": context.asMetadata()}) + "\n"
+
+# keys checked against the causal metadata at the same time
+LIST_CONCURRENCY = 64
+
+# walks the live keys after cursor in order, at most limit of them. yields the key to continue from
+# (None once there are no more) and the getData results of the keys of our shard
+async def checkedPages(body: dict, cursor: str | None, limit: int | None):
+    while limit is None or limit > 0:
+        size = LIST_CONCURRENCY if limit is None else min(LIST_CONCURRENCY, limit)
+        page = DATA.keysAfter(cursor, size)
+        if limit is not None:
+            limit -= len(page)
+        # a short page means we reached the last key
+        cursor = page[-1] if len(page) == size else None
+        page = [key for key in page if hashRing.assign(key)[0] == current_shard_id]
+        results = await asyncio.gather(*[getData(key, body, nodes=nodes, data=DATA, hashRing=hashRing, associatedNodes=associated_nodes, singleFlight=FETCHES) for key in page])
+        yield cursor, [(key, res, code) for key, (res, code) in zip(page, results)]
+        if cursor is None:
+            break
+
+
+# returns None if the node did not answer
+async def sendGossip(toNode:str, content: dict, uuid: str, seen: CausalContext | None = None) -> list[int] | None:
+    client = getPool().client(toNode)
+    body = {"data": content, "id": uuid}
+    if seen is not None:
+        body.update({"seen": seen.asDict(), "from": NAME})
+    try:
+        response = await client.put("/gossip",json=body, timeout=2)
+        res: list = response.json()
+    except httpx.TimeoutException:
+        res = None
+    return res
 
 async def gossipProtocol(differenceFinder: MerkleTreeDifferenceFinder, node: str):
     row = 1
     uuid = str(uuid1())
     res = None
+    # the first message also tells the node which operations we have seen since it last heard from us
+    stability = STABILITY
+    seen, version = DATA.seenSince(stability.acked.get(node, 0), STABILITY_BATCH)
     while True:
         outgoing = differenceFinder.dumpNextPyramidRow(row, res)
-        res = await sendGossip(node, outgoing, uuid)
+        res = await sendGossip(node, outgoing, uuid, seen if row == 1 else None)
+        if row == 1 and res is not None:
+            stability.acked[node] = version
+            updateStability(seen.vv.keys())
         row += 1
         if not res:
             return
 
+def updateStability(keys):
+    for key in keys:
+        clock = STABILITY.stableClock(key, DATA.frontier(key), nodes)
+        if clock:
+            DATA.markStable(key, clock)
+            STABILITY.forget(key, clock)
+
 async def gossip():
     while True:
         while reshuffle:
@@ -308,30 +663,27 @@ async def gossip():
         # don't send anything if there is no available nodes or no data
         if len(nodes) == 0:
             continue
-        if len(DATA) == 0:
+        if len(DATA) == 0 and DATA.tombstones() == 0:
             continue
 
         nums = [randrange(len(nodes)) for _ in range(min(len(nodes), 3))]
         nodesToSendTo = [nodes[num] for num in nums]
-        merkleTree = MerkleTree()
-        for key in DATA.get_all_keys():
-            merkleTree.insert(Payload(key, json.dumps(DATA.get(key).asDict())))
-        differenceFinder = MerkleTreeDifferenceFinder(merkleTree)
+        differenceFinder = MerkleTreeDifferenceFinder(DATA.merkleSnapshot(), DATA.nodeJson)
 
         tasks: list[asyncio.Task[tuple[str, list[int]]]] = []
         for node in nodesToSendTo:
             tasks.append( asyncio.create_task( gossipProtocol(differenceFinder, node) ) )
         await asyncio.wait(tasks, timeout=5)
+        DATA.collectGarbage(GC_BATCH)
+        # tombstones that became stable through this round's gossip are dropped for good
+        DATA.compactTombstones(GC_BATCH, lambda key, stable: STABILITY.settled(key, stable, nodes))
 
 def getMerkleFromCache(uuid: str) -> MerkleTreeDifferenceFinder:
     global merkleTreeCache
     if uuid in merkleTreeCache:
         return merkleTreeCache[uuid]
     else:
-        merkleTree = MerkleTree()
-        for key in DATA.get_all_keys():
-            merkleTree.insert(Payload(key, json.dumps(DATA.get(key).asDict())))
-        mtdf = MerkleTreeDifferenceFinder(merkleTree)
+        mtdf = MerkleTreeDifferenceFinder(DATA.merkleSnapshot())
         merkleTreeCache[uuid] = mtdf
         return mtdf
 def finishedWithMerkle(uuid: str):
@@ -340,23 +692,32 @@ def finishedWithMerkle(uuid: str):
         del merkleTreeCache[uuid]
 
 @app.route('/gossip', methods=['PUT'])
-def update_tree():
+async def update_tree():
     global DATA
 
     # receive tree and compare it to the
-    uuid = request.json["id"]
-    incoming = request.json["data"]
+    body = await getJson()
+    uuid = body["id"]
+    incoming = body["data"]
+    if "seen" in body:
+        seen = CausalContext.fromDict(body["seen"])
+        STABILITY.received(body["from"], seen)
+        updateStability(seen.vv.keys())
     differenceFinder = getMerkleFromCache(uuid)
     res = differenceFinder.compareForDifferences(incoming)
     for d in differenceFinder.getResult():
         key = d["key"]
         val = d["val"]
-        DATA.put(key, KvsNode.fromDict(json.loads(val)))
+        DATA.putShipped(key, json.loads(val))
     if not res:
         finishedWithMerkle(uuid)
     return res
 
 
 if __name__ == "__main__":
-    BGE.run(gossip())
-    app.run(host='0.0.0.0', port=PORT, debug=True)
+    if ASGI:
+        # gossip is started by startBackground once the serving loop is up
+        app.run(host='0.0.0.0', port=PORT)
+    else:
+        BGE.run(gossip())
+        app.run(host='0.0.0.0', port=PORT, debug=True)
@@ -0,0 +1,173 @@
+import unittest
+from bisect import bisect_left, bisect_right
+from typing import Any, Iterator
+
+# items per chunk before it is split in two
+CHUNK_SIZE = 1000
+
+# a sorted set kept as a list of sorted chunks, so inserting or removing only shifts one chunk.
+# finding an item is two bisects. snapshots share chunks until one side changes them.
+# not thread safe, callers lock around it
+class SortedIndex:
+    def __init__(self, items=(), chunkSize: int = CHUNK_SIZE) -> None:
+        self.chunkSize = chunkSize
+        items = sorted(set(items))
+        self._chunks: list[list] = [items[i:i + chunkSize] for i in range(0, len(items), chunkSize)]
+        # last item of every chunk
+        self._maxes: list = [chunk[-1] for chunk in self._chunks]
+        # false for chunks a snapshot may also be reading, they are copied before being changed
+        self._owned: list[bool] = [True] * len(self._chunks)
+        self._len = len(items)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, item) -> bool:
+        i = bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            return False
+        chunk = self._chunks[i]
+        j = bisect_left(chunk, item)
+        return chunk[j] == item
+
+    def __iter__(self) -> Iterator:
+        return self.irange()
+
+    # returns true if item was not in the index yet
+    def add(self, item) -> bool:
+        if not self._chunks:
+            self._chunks.append([item])
+            self._maxes.append(item)
+            self._owned.append(True)
+            self._len = 1
+            return True
+        i = bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            i -= 1
+        chunk = self._chunks[i]
+        j = bisect_left(chunk, item)
+        if j < len(chunk) and chunk[j] == item:
+            return False
+        chunk = self._own(i)
+        chunk.insert(j, item)
+        self._maxes[i] = chunk[-1]
+        self._len += 1
+        if len(chunk) > 2 * self.chunkSize:
+            self._chunks[i:i + 1] = [chunk[:self.chunkSize], chunk[self.chunkSize:]]
+            self._maxes[i:i + 1] = [chunk[self.chunkSize - 1], chunk[-1]]
+            self._owned[i:i + 1] = [True, True]
+        return True
+
+    # returns true if item was in the index
+    def discard(self, item) -> bool:
+        i = bisect_left(self._maxes, item)
+        if i == len(self._maxes):
+            return False
+        chunk = self._chunks[i]
+        j = bisect_left(chunk, item)
+        if chunk[j] != item:
+            return False
+        chunk = self._own(i)
+        del chunk[j]
+        self._len -= 1
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+            del self._owned[i]
+        return True
+
+    def _own(self, i: int) -> list:
+        if not self._owned[i]:
+            self._chunks[i] = list(self._chunks[i])
+            self._owned[i] = True
+        return self._chunks[i]
+
+    def clear(self):
+        self._chunks = []
+        self._maxes = []
+        self._owned = []
+        self._len = 0
+
+    # a copy that costs one reference per chunk instead of one per item
+    def snapshot(self) -> "SortedIndex":
+        copy = SortedIndex(chunkSize=self.chunkSize)
+        copy._chunks = list(self._chunks)
+        copy._maxes = list(self._maxes)
+        copy._len = self._len
+        self._owned = [False] * len(self._chunks)
+        copy._owned = [False] * len(self._chunks)
+        return copy
+
+    # items from start (inclusive) up to stop (exclusive), None means unbounded.
+    # the position is looked up again for every chunk, so the index may change between steps
+    def irange(self, start: Any = None, stop: Any = None, *, inclusive: bool = True) -> Iterator:
+        find = bisect_left if inclusive else bisect_right
+        while True:
+            if start is None:
+                if not self._chunks:
+                    return
+                i, j = 0, 0
+            else:
+                i = find(self._maxes, start)
+                if i == len(self._maxes):
+                    return
+                j = find(self._chunks[i], start)
+            chunk = self._chunks[i][j:]
+            if stop is not None and chunk[-1] >= stop:
+                yield from chunk[:bisect_left(chunk, stop)]
+                return
+            yield from chunk
+            start = chunk[-1]
+            find = bisect_right
+
+    # up to limit items after cursor, the first page when cursor is None
+    def page(self, cursor: Any, limit: int) -> list:
+        items = []
+        for item in self.irange(cursor, inclusive=False):
+            items.append(item)
+            if len(items) == limit:
+                break
+        return items
+
+class SortedIndexTests(unittest.TestCase):
+    def testSnapshot(self):
+        index = SortedIndex(range(0, 20, 2), chunkSize=2)
+        snapshot = index.snapshot()
+        index.add(5)
+        index.discard(10)
+        snapshot.add(7)
+        self.assertEqual(list(snapshot), [0, 2, 4, 6, 7, 8, 10, 12, 14, 16, 18])
+        self.assertEqual(list(index), [0, 2, 4, 5, 6, 8, 12, 14, 16, 18])
+        self.assertEqual(len(snapshot), 11)
+
+    def test(self):
+        index = SortedIndex(chunkSize=4)
+        for i in range(100, 0, -3):
+            self.assertTrue(index.add(i))
+        self.assertFalse(index.add(4))
+        expected = sorted(range(100, 0, -3))
+        self.assertEqual(list(index), expected)
+        self.assertEqual(len(index), len(expected))
+        self.assertTrue(index.discard(4))
+        self.assertFalse(index.discard(5))
+        expected.remove(4)
+        self.assertEqual(list(index), expected)
+        self.assertNotIn(4, index)
+        self.assertIn(7, index)
+        self.assertEqual(list(index.irange(10, 20)), [10, 13, 16, 19])
+        self.assertEqual(list(index.irange(10, 20, inclusive=False)), [13, 16, 19])
+
+    def testPages(self):
+        index = SortedIndex(map(str, range(50)), chunkSize=3)
+        seen, cursor = [], None
+        while page := index.page(cursor, 7):
+            seen += page
+            cursor = page[-1]
+            # changes behind the cursor do not disturb the walk
+            index.discard(page[0])
+        self.assertEqual(seen, sorted(map(str, range(50))))
+
+if __name__ == "__main__":
+    unittest.main()
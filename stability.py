@@ -0,0 +1,45 @@
+from operations import CausalContext
+
+# what the other replicas of our shard told us they have seen, piggybacked on gossip.
+# an operation is stable once every replica of the shard has seen it
+class StabilityTracker:
+    def __init__(self) -> None:
+        self.peerSeen: dict[str, CausalContext] = {}
+        self.acked: dict[str, int] = {} # peer -> Kvs change version it has received from us
+
+    def received(self, peer: str, seen: CausalContext):
+        self.peerSeen.setdefault(peer, CausalContext()).merge(seen)
+
+    # the part of own that every peer has seen too
+    def stableClock(self, key: str, own: dict[str, int], peers: list[str]) -> dict[str, int]:
+        clock = dict(own)
+        for peer in peers:
+            if not clock:
+                break
+            theirs = self.peerSeen.get(peer)
+            if theirs is None:
+                return {}
+            theirs = theirs.clock(key)
+            clock = {name: min(n, theirs[name]) for name, n in clock.items() if name in theirs}
+        return clock
+
+    # true once every peer reported on key and everything it reported is within stable.
+    # what forget dropped was stable already
+    def settled(self, key: str, stable: dict[str, int], peers: list[str]) -> bool:
+        for peer in peers:
+            theirs = self.peerSeen.get(peer)
+            if theirs is None:
+                return False
+            if any(n > stable.get(name, -1) for name, n in theirs.clock(key).items()):
+                return False
+        return True
+
+    # peers only ever report more, so what is stable no longer needs to be remembered per peer
+    def forget(self, key: str, stable: dict[str, int]):
+        for seen in self.peerSeen.values():
+            clock = seen.clock(key)
+            for name, n in list(clock.items()):
+                if n <= stable.get(name, -1):
+                    del clock[name]
+            if not clock:
+                seen.vv.pop(key, None)
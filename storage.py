@@ -0,0 +1,260 @@
+import os
+import json
+import unittest
+import tempfile
+from unittest import mock
+from concurrent.futures import Future
+from threading import Condition, Thread
+from typing import Callable, Iterable, Iterator
+
+# the write ahead log is compacted into a snapshot once it holds this many records
+SNAPSHOT_EVERY = 100000
+
+# append only log of json records plus a compacted snapshot, both one record per line.
+# appends are buffered and fsynced by a background thread, every fsync covers all appends made
+# before it started, so concurrent writers share them. recovery reads the snapshot, then the log
+class Storage:
+    def __init__(self, directory: str, *, snapshotEvery: int = SNAPSHOT_EVERY) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.snapshotEvery = snapshotEvery
+        self.snapshotPath = os.path.join(directory, "snapshot.jsonl")
+        self.walPath = os.path.join(directory, "wal.jsonl")
+        # the log being compacted into the next snapshot, only exists while that runs
+        self.oldWalPath = os.path.join(directory, "wal.old.jsonl")
+        self._repair()
+        self._cond = Condition()
+        self._file = open(self.walPath, "a", encoding="utf-8")
+        self._written = 0 # records appended
+        self._synced = 0 # records known to be on disk
+        self._waiting: list[tuple[int, Future]] = []
+        self._sinceSnapshot = 0
+        self._snapshotting: Thread | None = None
+        # returns every record needed to rebuild the current state, set by the owner
+        self._dump: Callable[[], Iterable[dict]] | None = None
+        self._closed = False
+        # set once an fsync failed, nothing appended after the last good one can be promised durable
+        self._error: OSError | None = None
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # undoes what a crash may have left behind so appends start on a clean log
+    def _repair(self):
+        if os.path.exists(self.walPath):
+            # drop a torn last line, it was never acknowledged
+            with open(self.walPath, "rb+") as f:
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+        if os.path.exists(self.oldWalPath):
+            # compaction did not finish, the old log goes back in front of the new one
+            tmp = self.walPath + ".tmp"
+            with open(tmp, "wb") as out:
+                for path in [self.oldWalPath, self.walPath]:
+                    if os.path.exists(path):
+                        with open(path, "rb") as f:
+                            out.write(f.read())
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp, self.walPath)
+            os.remove(self.oldWalPath)
+
+    # a number that is never handed out twice for this directory, kept in its own file so that
+    # wiping the data does not reset it
+    @staticmethod
+    def nextIncarnation(directory: str) -> int:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "incarnation")
+        incarnation = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                incarnation = int(f.read() or 0)
+        incarnation += 1
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(str(incarnation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        return incarnation
+
+    def attach(self, dump: Callable[[], Iterable[dict]]):
+        self._dump = dump
+
+    def records(self) -> Iterator[dict]:
+        for path in [self.snapshotPath, self.oldWalPath, self.walPath]:
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        break # torn write at the end of the file, nothing after it was acknowledged
+
+    # returns the record's sequence number for synced
+    def append(self, record: dict) -> int:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._cond:
+            self._file.write(line)
+            self._written += 1
+            self._sinceSnapshot += 1
+            self._cond.notify()
+            return self._written
+
+    # resolves once the record seq and everything before it is on disk, by default the last one appended
+    def synced(self, seq: int | None = None) -> Future:
+        future = Future()
+        with self._cond:
+            if seq is None:
+                seq = self._written
+            if seq <= self._synced:
+                future.set_result(True)
+            elif self._error is not None:
+                future.set_exception(self._error)
+            else:
+                self._waiting.append((seq, future))
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._synced == self._written and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                self._file.flush()
+                seq = self._written
+                fd = self._file.fileno()
+            # appends keep going into the buffer meanwhile and are picked up by the next fsync
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                # after a failed fsync the page cache may have dropped the data, retrying could
+                # report success for writes that are lost. everyone waiting, now or later, gets the error
+                print("wal fsync failed:", repr(e), flush=True)
+                with self._cond:
+                    self._error = e
+                    waiting = self._waiting
+                    self._waiting = []
+                for s, future in waiting:
+                    future.set_exception(e)
+                return
+            with self._cond:
+                self._synced = seq
+                waiting = [(s, f) for s, f in self._waiting if s > seq]
+                done = [f for s, f in self._waiting if s <= seq]
+                self._waiting = waiting
+                if self._sinceSnapshot >= self.snapshotEvery and self._dump is not None and self._snapshotting is None:
+                    self._rotate()
+            for future in done:
+                future.set_result(True)
+
+    # starts a new log and compacts the old one into a snapshot in the background.
+    # only called from _run holding the lock, so no fsync is running on the old file
+    def _rotate(self):
+        self._file.close()
+        os.replace(self.walPath, self.oldWalPath)
+        self._file = open(self.walPath, "a", encoding="utf-8")
+        self._sinceSnapshot = 0
+        self._snapshotting = Thread(target=self._snapshot, daemon=True)
+        self._snapshotting.start()
+
+    # the dump may already contain some records of the new log, so replaying the log after the snapshot
+    # brings back older records too. the owner's records must merge in any order
+    def _snapshot(self):
+        tmp = self.snapshotPath + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                for record in self._dump():
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshotPath)
+            os.remove(self.oldWalPath)
+        except OSError as e:
+            # the old log stays and _snapshotting stays set so no rotation overwrites it,
+            # the next start folds it back in
+            print("snapshot failed:", repr(e), flush=True)
+            return
+        with self._cond:
+            self._snapshotting = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        if self._snapshotting is not None:
+            self._snapshotting.join()
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            self._error = self._error or e
+        self._file.close()
+        for seq, future in self._waiting:
+            if self._error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(self._error)
+
+    # closes and deletes everything stored
+    def destroy(self):
+        self.close()
+        for path in [self.snapshotPath, self.oldWalPath, self.walPath, self.snapshotPath + ".tmp", self.walPath + ".tmp"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+class StorageTests(unittest.TestCase):
+    def testRecover(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = Storage(directory)
+            for i in range(100):
+                seq = storage.append({"i": i})
+            self.assertTrue(storage.synced(seq).result(5))
+            storage.close()
+            with open(storage.walPath, "a") as f:
+                f.write('{"i": 10')
+            storage = Storage(directory)
+            storage.append({"i": 100})
+            storage.close()
+            storage = Storage(directory)
+            self.assertEqual([r["i"] for r in storage.records()], list(range(101)))
+            storage.close()
+
+    def testFsyncFails(self):
+        with tempfile.TemporaryDirectory() as directory:
+            storage = Storage(directory)
+            with mock.patch("storage.os.fsync", side_effect=OSError(28, "No space left on device")):
+                synced = storage.synced(storage.append({"i": 0}))
+                self.assertRaises(OSError, synced.result, 5)
+                self.assertRaises(OSError, storage.synced(storage.append({"i": 1})).result, 5)
+            storage.close()
+
+    def testIncarnation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = Storage.nextIncarnation(directory)
+            Storage(directory).destroy()
+            self.assertEqual(Storage.nextIncarnation(directory), first + 1)
+
+    def testSnapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = {}
+            storage = Storage(directory, snapshotEvery=10)
+            storage.attach(lambda: [{"k": k, "v": v} for k, v in list(state.items())])
+            for i in range(95):
+                state[i % 7] = i
+                seq = storage.append({"k": i % 7, "v": i})
+                storage.synced(seq).result(5)
+            storage.close()
+            recovered = {}
+            storage = Storage(directory)
+            # the log may hold records older than the snapshot, replay has to merge rather than overwrite
+            for record in storage.records():
+                recovered[record["k"]] = max(record["v"], recovered.get(record["k"], -1))
+            storage.close()
+            self.assertEqual(recovered, state)
+            self.assertLess(os.path.getsize(storage.walPath), 95 * 20)
+
+if __name__ == "__main__":
+    unittest.main()